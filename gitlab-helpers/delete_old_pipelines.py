@@ -1,24 +1,44 @@
-# This script deletes old pipelines from a GitLab project including all
-# related artifacts and jobs.
+# This script deletes old pipelines from a GitLab project or from all projects
+# of a group and its subgroups including all related artifacts and jobs.
 # The time for which the pipelines are kept can be configured by using
 # the --keep-time argument. Which takes the time in the format of 10d or 2w etc.
 # It is intended to be run as a cron job.
 # It requires the GitLab API token to be set in the environment variable
 # GITLAB_API_TOKEN.
+# At the end a summary of the deleted pipelines and freed artifact storage per
+# project is printed. In dry run mode the summary estimates the reclaimable storage.
 
 import argparse
 import datetime
-import gitlab
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+
+import gitlab_client
+
+PIPELINE_STATUSES = ['created', 'waiting_for_resource', 'preparing', 'pending', 'running', 'success', 'failed',
+                     'canceled', 'skipped', 'manual', 'scheduled']
 
 def parse_args():
-    parser = argparse.ArgumentParser(description='Delete old pipelines from a GitLab project.')
-    parser.add_argument('--project', required=True, help='The project ID or path of the project')
+    parser = argparse.ArgumentParser(description='Delete old pipelines from a GitLab project or group.')
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--project', help='The project ID or path of the project')
+    target.add_argument('--group', help='The group ID or path, all projects of the group and its subgroups are cleaned')
     parser.add_argument('--keep-time', default='365d', help='The time for which the pipelines are kept')
     parser.add_argument('--dry-run', action='store_true', help='Do not delete anything, just print what would be deleted')
     parser.add_argument('--url', required=True, default='https://gitlab.com', help='The url of the GitLab instance')
     parser.add_argument('--token', required=True, help='The GitLab API token')
+    parser.add_argument('--concurrency', type=int, default=4, help='The number of pipelines deleted in parallel')
+    parser.add_argument('--journal', help='File recording the progress, used to resume an interrupted run')
+    parser.add_argument('--status', action='append', choices=PIPELINE_STATUSES,
+                        help='Only delete pipelines with this status, can be given multiple times. '
+                             'Defaults to success, failed, canceled and skipped')
 
-    return parser.parse_args()
+    arguments = parser.parse_args()
+    if not arguments.status:
+        arguments.status = ['success', 'failed', 'canceled', 'skipped']
+    return arguments
 
 def parse_keep_time(keep_time):
     if keep_time[-1] == 'd':
@@ -32,54 +52,196 @@ def parse_keep_time(keep_time):
     else:
         raise ValueError('Invalid time format')
 
+class Journal:
+    """
+    Append only file recording the jobs whose artifacts and the pipelines which have been
+    deleted, so an interrupted run can be resumed without repeating finished deletes.
+    The file is removed once a run completes, so the next run starts with an empty journal.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = set()
+        self.lock = threading.Lock()
+        self.journal_file = None
+
+    def __enter__(self):
+        if self.path:
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as journal_file:
+                    self.entries = {line.strip() for line in journal_file if line.strip()}
+                print(f'Resuming from journal {self.path} with {len(self.entries)} entries')
+            # pylint: disable=R1732
+            self.journal_file = open(self.path, 'a', encoding='utf-8')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        if exc_type is None and self.path:
+            os.remove(self.path)
+
+    def contains(self, kind, object_id):
+        return f'{kind} {object_id}' in self.entries
+
+    def record(self, kind, object_id):
+        entry = f'{kind} {object_id}'
+        with self.lock:
+            self.entries.add(entry)
+            if self.journal_file:
+                self.journal_file.write(entry + '\n')
+                self.journal_file.flush()
+
+    def close(self):
+        if self.journal_file:
+            self.journal_file.close()
+
+
+def is_old_enough(pipeline, updated_before):
+    # GitLab returns timestamps in UTC with a fixed format like 2023-01-31T12:00:00.000Z,
+    # so comparing them as strings with a cutoff formatted the same way is sufficient
+    return pipeline.updated_at < updated_before
+
+
+@dataclass
+class ProjectSummary:
+    path: str
+    pipelines: int = 0
+    artifact_bytes: int = 0
+    started: float = field(default_factory=time.monotonic)
+    finished: float = None
+
+    def add(self, artifact_bytes):
+        self.pipelines += 1
+        self.artifact_bytes += artifact_bytes
+        self.finished = time.monotonic()
+
+    def duration(self):
+        return (self.finished or self.started) - self.started
+
+
+def print_summary(summaries, dry_run):
+    action = 'would be deleted' if dry_run else 'deleted'
+    for summary in summaries:
+        print(f'{summary.path}: {summary.pipelines} pipelines {action}, '
+              f'{summary.artifact_bytes / 1024 ** 2:.1f} MiB artifacts in {summary.duration():.1f}s')
+    total_pipelines = sum(summary.pipelines for summary in summaries)
+    total_bytes = sum(summary.artifact_bytes for summary in summaries)
+    print(f'Total: {total_pipelines} pipelines {action} in {len(summaries)} projects, '
+          f'{total_bytes / 1024 ** 2:.1f} MiB artifacts {"reclaimable" if dry_run else "freed"}')
+
+
+def find_projects(gl, args):
+    if args.project:
+        project = gl.projects.get(args.project)
+        yield project, project.path_with_namespace
+        return
+
+    group = gl.groups.get(args.group)
+    # Projects only shared with the group belong to other groups and must not be touched,
+    # archived projects are read-only
+    group_projects = group.projects.list(include_subgroups=True, with_shared=False, archived=False,
+                                         iterator=True)
+    for group_project in group_projects:
+        # Group projects have no pipelines, a lazy project does without an extra request
+        yield gl.projects.get(group_project.id, lazy=True), group_project.path_with_namespace
+
+
+def delete_pipeline(project, pipeline, journal, dry_run):
+    """
+    Delete the artifacts of all jobs of the pipeline and the pipeline itself.
+    :return: The size of the deleted artifacts in bytes, None if an interrupted run deleted the
+    pipeline already.
+    """
+    artifact_bytes = 0
+    if journal.contains('pipeline', pipeline.id):
+        return None
+
+    for pipeline_job in pipeline.jobs.list(all=True):
+        if journal.contains('artifacts', pipeline_job.id):
+            continue
+        artifact_bytes += sum(artifact.get('size') or 0 for artifact in pipeline_job.attributes.get('artifacts', []))
+        if dry_run:
+            print(f'Would delete artifacts of job {pipeline_job.id}')
+            continue
+        # A lazy job object only knows its id which is all delete_artifacts needs,
+        # so there is no need to fetch the job first
+        project.jobs.get(pipeline_job.id, lazy=True).delete_artifacts()
+        journal.record('artifacts', pipeline_job.id)
+
+    if dry_run:
+        print(f'Would delete pipeline {pipeline.id} finished at {pipeline.updated_at}')
+        return artifact_bytes
+
+    print(f'Deleting pipeline {pipeline.id} finished at {pipeline.updated_at}')
+    pipeline.delete()
+    journal.record('pipeline', pipeline.id)
+    print(f'Successfully deleted pipeline {pipeline.id}')
+    return artifact_bytes
+
+
+def find_old_pipeline_pages(project, updated_before, statuses, dry_run):
+    """
+    Yield the old pipelines of a project page by page instead of listing all of them upfront.
+    The API only filters by a single status, so every status is listed on its own. Deleted
+    pipelines disappear from the list, so unless nothing is deleted the first page is requested
+    again once the previous page has been handled.
+    """
+    for status in statuses:
+        seen_pipeline_ids = set()
+        page = 1
+        while True:
+            pipelines = [pipeline for pipeline in
+                         project.pipelines.list(updated_before=updated_before, status=status, sort='asc',
+                                                per_page=100, page=page)
+                         if pipeline.id not in seen_pipeline_ids and is_old_enough(pipeline, updated_before)]
+            if not pipelines:
+                break
+            seen_pipeline_ids.update(pipeline.id for pipeline in pipelines)
+            yield pipelines
+            if dry_run:
+                page += 1
+
+
 def main():
     args = parse_args()
     keep_time = parse_keep_time(args.keep_time)
-    gl = gitlab.Gitlab(args.url, args.token)
-    project = gl.projects.get(args.project)
+    gl = gitlab_client.connect(args.url, args.token, pool_size=args.concurrency * 2)
+    gitlab_client.RateLimiter().install(gl.session)
 
-    # jobs = project.jobs.list(order_by="finished_at", sort='asc', per_page=100, all=True)
-    # for job in jobs:
-    #     print(job.finished_at)
-
-    # Convert the keep_time to a datetime object and format it to the ISO 8601 format
-    updated_before = (datetime.datetime.now(datetime.timezone.utc) - keep_time).isoformat()
+    # Convert the keep_time to a datetime object and format it to the ISO 8601 format used by GitLab
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - keep_time
+    updated_before = cutoff.strftime('%Y-%m-%dT%H:%M:%S.') + f'{cutoff.microsecond // 1000:03d}Z'
 
     # Print the date for which we are deleting pipelines
     print(f'Deleting pipelines finished before {updated_before}')
 
-    pipelines = project.pipelines.list(updated_before=updated_before, sort='asc', per_page=100, all=True)
-    for pipeline in pipelines:
-        if pipeline.status == 'running':
-            continue
-
-        current_utc_time = datetime.datetime.now(datetime.timezone.utc)
-        pipeline_updated_at = pipeline.updated_at
-
-        # To convert the pipeline_updated_at to a datetime object we need to
-        # use the correct pattern for the ISO 8601 format
-        time_pipeline_updated = datetime.datetime.strptime(pipeline_updated_at, '%Y-%m-%dT%H:%M:%S.%fZ')
-
-        # In order to calculate the time diff we need to convert the time to the same time zone
-        time_pipeline_updated = time_pipeline_updated.replace(tzinfo=datetime.timezone.utc)
-        # Now we can calculate the time diff
-        time_diff = current_utc_time - time_pipeline_updated
-
-        # Print the time diff in days
-        print(f'Pipeline {pipeline.id} finished {time_diff.days} days ago')
-
-        # Compare time zones to make sure we are comparing the same time
-        if time_diff > keep_time:
-
-            jobs = pipeline.jobs.list(all=True)
-            for pipeline_job in jobs:
-                job = project.jobs.get(pipeline_job.id, lazy=False)
-                job.delete_artifacts()
-
-            print(f'Deleting pipeline {pipeline.id} finished at {pipeline_updated_at}')
-            pipeline.delete()
-            print(f'Successfully deleted pipeline {pipeline.id}')
+    # Projects are cleaned concurrently, each deleting the pipelines of a page concurrently as well.
+    # The semaphore caps the deletes running at the same time across all projects
+    delete_budget = threading.BoundedSemaphore(args.concurrency)
+
+    def delete(project, pipeline):
+        with delete_budget:
+            return delete_pipeline(project, pipeline, journal, args.dry_run)
+
+    def clean_project(project_and_path):
+        project, path = project_and_path
+        summary = ProjectSummary(path)
+        print(f'Checking project {path}')
+        for pipelines in find_old_pipeline_pages(project, updated_before, args.status, args.dry_run):
+            for artifact_bytes in gitlab_client.run_concurrently(
+                    lambda pipeline: delete(project, pipeline), pipelines, args.concurrency):
+                if artifact_bytes is not None:
+                    summary.add(artifact_bytes)
+        return summary
+
+    summaries = []
+    try:
+        with Journal(args.journal) as journal:
+            for summary in gitlab_client.run_concurrently(clean_project, find_projects(gl, args), args.concurrency):
+                summaries.append(summary)
+    finally:
+        print_summary(summaries, args.dry_run)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
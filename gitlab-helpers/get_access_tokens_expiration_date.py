@@ -1,46 +1,96 @@
 """
 This script checks all access tokens for nearing expiration date.
+Tokens are either discovered by walking a group tree or, for administrators, by listing all
+project and group access tokens of the instance into a local SQLite inventory which later runs
+only update.
 """
+import argparse
+import csv
 import datetime
+import json
+import sqlite3
 import sys
+import threading
+from types import SimpleNamespace
 
 import gitlab
 
+import gitlab_client
 
-def connect_to_gitlab(url, token):
+
+def connect_to_gitlab(url, token, pool_size=10):
     """
     Connect to GitLab instance.
     :param url: The URL of the GitLab instance.
     :param token: The access token for the GitLab instance. Requires full api scope.
+    :param pool_size: The number of connections to keep open, at least the number of threads.
     :return: A GitLab instance.
     """
-    return gitlab.Gitlab(url, private_token=token)
+    return gitlab_client.connect(url, token, pool_size=pool_size)
+
+
+class ReportWriter:
+    """
+    Writes one record per checked access token as JSON Lines or CSV as soon as the token has been
+    evaluated. Safe to use from several threads.
+    """
+    fields = ["owner_type", "path", "token_id", "token_name", "expires_at", "days_left",
+              "needs_renewal"]
 
+    def __init__(self, stream, output_format):
+        self.stream = stream
+        self.output_format = output_format
+        self.lock = threading.Lock()
+        self.csv_writer = None
+        if output_format == "csv":
+            self.csv_writer = csv.DictWriter(stream, fieldnames=self.fields)
+            self.csv_writer.writeheader()
 
-def check_all_access_tokens(project_or_group):
+    def write(self, owner_type, path, access_token, days_left, threshold_days):
+        record = {"owner_type": owner_type, "path": path, "token_id": access_token.id,
+                  "token_name": access_token.name, "expires_at": access_token.expires_at,
+                  "days_left": days_left,
+                  "needs_renewal": days_left is not None and days_left < threshold_days}
+        with self.lock:
+            if self.csv_writer:
+                self.csv_writer.writerow(record)
+            else:
+                self.stream.write(json.dumps(record) + "\n")
+            self.stream.flush()
+
+
+def check_all_access_tokens(project_or_group, threshold_days=90, report=None):
     """
     Check all access tokens for a project or group.
-    :param project_or_group: The project or group to check.
+    :param project_or_group: The project or group to check as returned by a list call.
+    :param threshold_days: Tokens expiring in less days need to be renewed.
+    :param report: An optional ReportWriter receiving a record for every checked token.
     :return: A list of expired access tokens or tokens nearing expiration date.
     """
     expired_project_or_group_tokens = []
 
+    # Lazy objects give access to the access tokens without fetching the project / group again
     is_group = True
     if isinstance(project_or_group, gitlab.v4.objects.GroupProject):
-        complete_project_or_group = gl.projects.get(project_or_group.id)
+        tokens_owner = gl.projects.get(project_or_group.id, lazy=True)
         is_group = False
     else:
-        complete_project_or_group = gl.groups.get(project_or_group.id)
+        tokens_owner = gl.groups.get(project_or_group.id, lazy=True)
 
     try:
-        for access_token in complete_project_or_group.access_tokens.list(all=True):
+        for access_token in tokens_owner.access_tokens.list(all=True):
             print(f"Checking token {access_token.name}")
-            exp_token = is_expired(access_token)
+            exp_token = is_expired(access_token, threshold_days)
+            if report:
+                report.write("group" if is_group else "project",
+                             project_or_group.full_path if is_group
+                             else project_or_group.path_with_namespace,
+                             access_token, days_until_expiration(access_token), threshold_days)
             if exp_token:
                 expired_project_or_group_tokens.append(exp_token)
-                print_expired_token_details(complete_project_or_group, exp_token, is_group)
+                print_expired_token_details(project_or_group, exp_token, is_group)
     except gitlab.exceptions.GitlabAuthenticationError:
-        print(f"Could not get access tokens for {complete_project_or_group.name}. "
+        print(f"Could not get access tokens for {project_or_group.name}. "
               f"Check if you have access to the project / group.")
 
     return expired_project_or_group_tokens
@@ -67,64 +117,259 @@ def print_expired_token_details(complete_project_or_group, exp_token, is_group):
           " https://docs.gitlab.com/ee/api/access_requests.html\033[0m")
 
 
-def is_expired(access_token):
+def days_until_expiration(access_token):
     """
-    Check if an access token is expired or nearing expiration date.
+    Calculate the number of days until an access token expires.
     :param access_token: The access token to check.
-    :return: The access token if it is expired, None otherwise.
+    :return: The number of days, negative if already expired, None if the token never expires.
     """
+    if not access_token.expires_at:
+        return None
     expiration_date = datetime.datetime.strptime(access_token.expires_at, "%Y-%m-%d")
+    return (expiration_date - datetime.datetime.utcnow()).days
+
 
-    difference = expiration_date - datetime.datetime.utcnow()
-    if difference.days < 90:
+def is_expired(access_token, threshold_days=90):
+    """
+    Check if an access token is expired or nearing expiration date.
+    :param access_token: The access token to check.
+    :param threshold_days: Tokens expiring in less days are considered as nearing expiration date.
+    :return: The access token if it is expired, None otherwise.
+    """
+    days_left = days_until_expiration(access_token)
+    if days_left is not None and days_left < threshold_days:
         print(f"\033[91mToken {access_token.name} has an expiration date of"
               f" {access_token.expires_at}"
-              f" and expires in {difference.days} days.\033[0m")
+              f" and expires in {days_left} days.\033[0m")
         return access_token
     return None
 
 
-def walk_groups_and_projects(gitlab_instance, group_path):
+# pylint: disable=R0913
+def walk_groups_and_projects(gitlab_instance, group_path, max_workers=8, threshold_days=90,
+                             report=None):
     """
     Walk all groups and projects in a group and check all access tokens for expiration date.
+    All subgroups and projects are listed with one paginated request each, their access tokens
+    are checked concurrently.
     :param gitlab_instance: The GitLab instance.
     :param group_path: The path of the group to walk.
+    :param max_workers: The maximum number of groups and projects checked at the same time.
+    :param threshold_days: Tokens expiring in less days need to be renewed.
+    :param report: An optional ReportWriter receiving a record for every checked token.
     :return: A list of all tokens nearing expiration date or are expired.
     """
-    collected_expired_tokens = []
     group = gitlab_instance.groups.get(group_path)
-    print(f"Checking group '{group.full_path}' for nearly expired access tokens.")
-    expired_group_or_project_tokens = check_all_access_tokens(group)
-    if expired_group_or_project_tokens:
-        collected_expired_tokens.append(expired_group_or_project_tokens)
-    projects = group.projects.list(all=True)
-    for project in projects:
-        print(f"Checking project '{project.path_with_namespace}' for nearly expired access tokens.")
-        expired_group_or_project_tokens = check_all_access_tokens(project)
-        if expired_group_or_project_tokens:
-            collected_expired_tokens.append(expired_group_or_project_tokens)
-    subgroups = group.subgroups.list(all=True)
-    for subgroup in subgroups:
-        collected_expired_tokens.extend(walk_groups_and_projects(
-            gitlab_instance, subgroup.full_path))
-    return collected_expired_tokens
+
+    def groups_and_projects():
+        yield group
+        yield from group.descendant_groups.list(iterator=True)
+        yield from group.projects.list(include_subgroups=True, iterator=True)
+
+    def check(project_or_group):
+        if isinstance(project_or_group, gitlab.v4.objects.GroupProject):
+            print(f"Checking project '{project_or_group.path_with_namespace}' "
+                  f"for nearly expired access tokens.")
+        else:
+            print(f"Checking group '{project_or_group.full_path}' "
+                  f"for nearly expired access tokens.")
+        return check_all_access_tokens(project_or_group, threshold_days, report)
+
+    return [expired_group_or_project_tokens for expired_group_or_project_tokens
+            in gitlab_client.run_concurrently(check, groups_and_projects(), max_workers)
+            if expired_group_or_project_tokens]
+
+
+class TokenInventory:
+    """
+    Local SQLite inventory of the project and group access tokens of a GitLab instance keyed by
+    token id. Project and group access tokens belong to bot users, so an administrator can list
+    them through the instance wide personal access tokens API. That API also lists the personal
+    access tokens of all human users, these are left out. The project or group owning a bot user
+    is resolved once from its membership and kept in the inventory as well.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS tokens (id INTEGER PRIMARY KEY,"
+                                    " name TEXT, user_id INTEGER, expires_at TEXT,"
+                                    " created_at TEXT, fetched_at TEXT)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS meta"
+                                    " (key TEXT PRIMARY KEY, value TEXT)")
+            # owner_type is NULL for human users
+            self.connection.execute("CREATE TABLE IF NOT EXISTS owners"
+                                    " (user_id INTEGER PRIMARY KEY, owner_type TEXT, path TEXT)")
+
+    @staticmethod
+    def find_owner(gitlab_instance, user_id):
+        """
+        Find the project or group a bot user belongs to.
+        :return: The owner type (project, group or user for bots without membership) and path,
+        (None, None) for human users.
+        """
+        user = gitlab_instance.users.get(user_id)
+        if not user.attributes.get("bot"):
+            return None, None
+        for membership in user.memberships.list(iterator=True):
+            if membership.source_type == "Project":
+                return "project", gitlab_instance.projects.get(
+                    membership.source_id).path_with_namespace
+            if membership.source_type == "Namespace":
+                return "group", gitlab_instance.groups.get(membership.source_id).full_path
+        return "user", f"user/{user.username}"
+
+    def resolve_owners(self, gitlab_instance, user_ids):
+        known_user_ids = {user_id for (user_id,) in self.connection.execute(
+            "SELECT user_id FROM owners")}
+        stored_user_ids = {user_id for (user_id,) in self.connection.execute(
+            "SELECT DISTINCT user_id FROM tokens")}
+        unknown_user_ids = sorted((set(user_ids) | stored_user_ids) - known_user_ids)
+        owners = [(user_id, *self.find_owner(gitlab_instance, user_id))
+                  for user_id in unknown_user_ids]
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO owners VALUES (?, ?, ?)", owners)
+            self.connection.execute("DELETE FROM tokens WHERE user_id IN"
+                                    " (SELECT user_id FROM owners WHERE owner_type IS NULL)")
+        if owners:
+            print(f"Resolved the owners of {len(owners)} users.")
+        return {user_id for (user_id,) in self.connection.execute(
+            "SELECT user_id FROM owners WHERE owner_type IS NOT NULL")}
+
+    def refresh(self, gitlab_instance, max_age):
+        """
+        Bring the inventory up to date. All tokens are listed again once the last full listing
+        is older than max_age, otherwise only tokens created after the newest known token are
+        fetched.
+        :param gitlab_instance: The GitLab instance. Requires an administrator token.
+        :param max_age: The timedelta after which the inventory is listed completely again.
+        """
+        now = datetime.datetime.utcnow()
+        last_full_refresh = self.connection.execute(
+            "SELECT value FROM meta WHERE key = 'last_full_refresh'").fetchone()
+        newest = self.connection.execute("SELECT MAX(created_at) FROM tokens").fetchone()[0]
+        full_refresh = not last_full_refresh or not newest or \
+            now - datetime.datetime.fromisoformat(last_full_refresh[0]) > max_age
+
+        list_filters = {"state": "active"}
+        if full_refresh:
+            print("Listing all active access tokens of the instance.")
+        else:
+            print(f"Listing access tokens created after {newest}.")
+            list_filters["created_after"] = newest
+
+        tokens = gitlab_instance.personal_access_tokens.list(iterator=True, **list_filters)
+        tokens = list(tokens)
+        bot_user_ids = self.resolve_owners(gitlab_instance, {token.user_id for token in tokens})
+        rows = [(token.id, token.name, token.user_id, token.expires_at, token.created_at,
+                 now.isoformat()) for token in tokens if token.user_id in bot_user_ids]
+        with self.connection:
+            if full_refresh:
+                self.connection.execute("DELETE FROM tokens")
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('last_full_refresh', ?)",
+                    (now.isoformat(),))
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO tokens VALUES (?, ?, ?, ?, ?, ?)", rows)
+        print(f"Stored {len(rows)} access tokens in the inventory.")
+
+    def tokens_with_expiration_date(self):
+        for token_id, name, user_id, expires_at, owner_type, path in self.connection.execute(
+                "SELECT id, name, tokens.user_id, expires_at, owner_type, path"
+                " FROM tokens JOIN owners ON tokens.user_id = owners.user_id"
+                " WHERE expires_at IS NOT NULL AND owner_type IS NOT NULL ORDER BY id"):
+            yield SimpleNamespace(id=token_id, name=name, user_id=user_id, expires_at=expires_at,
+                                  owner_type=owner_type, path=path,
+                                  attributes={"id": token_id, "name": name, "user_id": user_id,
+                                              "expires_at": expires_at, "owner": path})
+
+
+def check_inventory(gitlab_instance, inventory_path, max_age, threshold_days=90, report=None):
+    """
+    Check all project and group access tokens of the instance using the local inventory.
+    :param gitlab_instance: The GitLab instance. Requires an administrator token.
+    :param inventory_path: The path of the SQLite inventory.
+    :param max_age: The timedelta after which the inventory is listed completely again.
+    :param threshold_days: Tokens expiring in less days need to be renewed.
+    :param report: An optional ReportWriter receiving a record for every checked token.
+    :return: A list containing the list of tokens nearing expiration date or are expired.
+    """
+    inventory = TokenInventory(inventory_path)
+    inventory.refresh(gitlab_instance, max_age)
+    expired_tokens = []
+    for access_token in inventory.tokens_with_expiration_date():
+        if report:
+            report.write(access_token.owner_type, access_token.path, access_token,
+                         days_until_expiration(access_token), threshold_days)
+        if is_expired(access_token, threshold_days):
+            expired_tokens.append(access_token)
+            print(f"\033[91mToken {access_token.name} in {access_token.owner_type} "
+                  f"{access_token.path} is expired or nears expiration date and needs to be "
+                  f"renewed.\033[0m")
+            print(f"\033[91mToken details: {access_token.attributes}\033[0m")
+    return [expired_tokens] if expired_tokens else []
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Check all access tokens for nearing expiration date.')
+    parser.add_argument('gitlab_url', help='The URL of the GitLab instance')
+    parser.add_argument('gitlab_token', help='The access token for the GitLab instance')
+    parser.add_argument('root_group', nargs='?', help='The path of the group to walk')
+    parser.add_argument('concurrency', nargs='?', type=int, default=8,
+                        help='The number of groups and projects checked at the same time')
+    parser.add_argument('--inventory',
+                        help='Path of a SQLite inventory of all project and group access tokens '
+                             'of the instance. Requires an administrator token, replaces walking '
+                             'a group')
+    parser.add_argument('--max-age', type=int, default=24,
+                        help='Hours after which the inventory is listed completely again')
+    parser.add_argument('--threshold-days', type=int, default=90,
+                        help='Tokens expiring in less days need to be renewed')
+    parser.add_argument('--report-format', choices=['jsonl', 'csv'],
+                        help='Write a record for every checked token as soon as it is evaluated')
+    parser.add_argument('--report', default='-',
+                        help='File the records are written to, defaults to stdout in which case '
+                             'all other output is written to stderr')
+    arguments = parser.parse_args()
+    if not arguments.root_group and not arguments.inventory:
+        parser.error('either root_group or --inventory is required')
+    return arguments
 
 
 if __name__ == '__main__':
     # Check all access tokens for nearing expiration date starting from the path of a group.
     # Usage: python3 get_access_tokens_expiration_date.py <gitlab_url> <gitlab_token>
-    # <root_group_path>
+    # <root_group_path> [<concurrency>]
     # Example: python3 get_access_tokens_expiration_date.py https://gitlab.example.com/
     # ghjkl1234567890qwertyuiop my-root-group
-    gitlab_url = sys.argv[1]
-    gitlab_token = sys.argv[2]
-    root_group = sys.argv[3]
+    # Alternatively check all tokens of the instance using a local inventory (requires admin scope):
+    # python3 get_access_tokens_expiration_date.py <gitlab_url> <gitlab_token> --inventory tokens.db
+    args = parse_args()
+
+    report_writer = None
+    if args.report_format:
+        if args.report == '-':
+            report_writer = ReportWriter(sys.stdout, args.report_format)
+            # Keep stdout free for the records
+            sys.stdout = sys.stderr
+        else:
+            # pylint: disable=R1732
+            report_writer = ReportWriter(open(args.report, 'w', encoding='utf-8', newline=''),
+                                         args.report_format)
 
     # Create a GitLab instance
-    gl = connect_to_gitlab(gitlab_url, gitlab_token)
+    gl = connect_to_gitlab(args.gitlab_url, args.gitlab_token, args.concurrency)
+    gitlab_client.RateLimiter().install(gl.session)
 
-    # Get all projects and groups
-    all_expired_tokens = walk_groups_and_projects(gl, root_group)
+    if args.inventory:
+        all_expired_tokens = check_inventory(gl, args.inventory,
+                                             datetime.timedelta(hours=args.max_age),
+                                             args.threshold_days, report_writer)
+    else:
+        # Get all projects and groups
+        all_expired_tokens = walk_groups_and_projects(gl, args.root_group, args.concurrency,
+                                                      args.threshold_days, report_writer)
     if all_expired_tokens:
         print("\033[91mThe following access tokens are nearing expiration date"
               " and need to be renewed:")
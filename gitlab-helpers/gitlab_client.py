@@ -0,0 +1,260 @@
+"""
+Shared GitLab client setup for the GitLab helper scripts.
+All scripts get a python-gitlab instance whose session keeps a pool of keep-alive connections,
+retries transient errors with exponential backoff and can be throttled by GitLab's rate limit
+headers. Paginated lists can be consumed while the next page is already being fetched.
+Large job traces can be compressed into chunks while they are downloaded, job documents of
+all scripts are built the same way.
+"""
+import collections
+import logging
+import queue
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator
+from urllib.parse import urlparse
+
+import gitlab
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger('gitlab-client')
+
+
+def connect(url: str, private_token: str, pool_size: int = 10, retries: int = 5,
+            backoff_factor: float = 0.5, per_page: int = 100) -> gitlab.Gitlab:
+    """
+    Create a GitLab instance using a pooled session.
+    :param url: The URL of the GitLab instance.
+    :param private_token: The access token for the GitLab instance.
+    :param pool_size: The maximum number of connections kept open per host. Should be at least
+    the number of threads using the instance concurrently.
+    :param retries: How often requests failing because of connection errors are retried.
+    :param backoff_factor: The base of the exponential backoff between retries in seconds.
+    :param per_page: The default page size for paginated lists.
+    :return: A GitLab instance.
+    """
+    # Connection and read errors of idempotent requests are retried by urllib3, error responses
+    # like 429 and 5xx by python-gitlab itself because of retry_transient_errors
+    retry = Retry(total=retries, status=0, backoff_factor=backoff_factor)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return gitlab.Gitlab(url, private_token=private_token, session=session, per_page=per_page,
+                         retry_transient_errors=True)
+
+
+class RateLimiter:
+    """
+    Throttles all threads sharing a GitLab session once a host signals that its rate limit
+    is (nearly) used up. GitLab sends RateLimit-Remaining / RateLimit-Reset on every
+    response and Retry-After on 429 responses.
+    See https://docs.gitlab.com/ee/user/gitlab_com/index.html#gitlabcom-specific-rate-limits
+    Requests wait before they are sent, so no thread sends another request while a host is
+    paused. The thread receiving a 429 response is already put to sleep by python-gitlab for
+    Retry-After seconds, by the time it retries the pause is over, so it does not wait twice.
+    """
+
+    def __init__(self, min_remaining: int = 10):
+        self.min_remaining = min_remaining
+        self.paused_until: Dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    def install(self, session: requests.Session):
+        session.hooks["response"].append(self.on_response)
+        # The same adapter is usually mounted for http:// and https://
+        for adapter in {id(adapter): adapter for adapter in session.adapters.values()}.values():
+            adapter.send = self.throttled(adapter.send)
+
+    def throttled(self, send: Callable) -> Callable:
+        def throttled_send(request: requests.PreparedRequest, *args, **kwargs):
+            self.wait(urlparse(request.url).netloc)
+            return send(request, *args, **kwargs)
+        return throttled_send
+
+    def wait(self, host: str):
+        with self.lock:
+            wait = self.paused_until.get(host, 0) - time.time()
+        if wait > 0:
+            time.sleep(wait)
+
+    # pylint: disable=W0613
+    def on_response(self, response: requests.Response, *args, **kwargs):
+        if not (pause := self.pause_requested_by(response)):
+            return
+        host = urlparse(response.url).netloc
+        resume_at = time.time() + pause
+        with self.lock:
+            if resume_at > self.paused_until.get(host, 0):
+                logger.warning("Rate limit of %s reached, pausing for %.1fs", host, pause)
+                self.paused_until[host] = resume_at
+
+    def pause_requested_by(self, response: requests.Response) -> float:
+        if retry_after := response.headers.get("Retry-After"):
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        remaining = response.headers.get("RateLimit-Remaining")
+        reset = response.headers.get("RateLimit-Reset")
+        if remaining is not None and reset is not None and int(remaining) <= self.min_remaining:
+            return max(int(reset) - time.time(), 0)
+        return 0
+
+
+_END_OF_LIST = object()
+
+
+def prefetch(items: Iterable, buffer_size: int = 100) -> Iterator:
+    """
+    Iterate over a lazily paginated list, e.g. the result of manager.list(iterator=True), while
+    a background thread already fetches the following items and pages.
+    :param items: The items to iterate over.
+    :param buffer_size: The maximum number of items fetched ahead, usually the page size.
+    :return: An iterator over the items.
+    """
+    buffer = queue.Queue(maxsize=buffer_size)
+    stop = threading.Event()
+
+    def fetch():
+        try:
+            for item in items:
+                while not stop.is_set():
+                    try:
+                        buffer.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+            buffer.put(_END_OF_LIST)
+        # pylint: disable=W0703
+        except Exception as error:
+            buffer.put(error)
+
+    threading.Thread(target=fetch, daemon=True).start()
+    try:
+        while (item := buffer.get()) is not _END_OF_LIST:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+class TraceChunker:
+    """
+    Gzip compresses a trace while it is downloaded and passes it on in chunks of chunk_size
+    compressed bytes (GridFS style), so a trace never has to be held in memory completely and
+    is not limited by the maximum document size of a database. Chunks are linked to their job
+    by job_id and numbered by n.
+    """
+
+    def __init__(self, job_id: int, write_chunk: Callable[[Dict], None],
+                 chunk_size: int = 255 * 1024):
+        self.job_id = job_id
+        self.write_chunk = write_chunk
+        self.chunk_size = chunk_size
+        # wbits=31 produces a gzip instead of a zlib stream
+        self.compressor = zlib.compressobj(wbits=31)
+        self.pending = bytearray()
+        self.chunks = 0
+        self.size = 0
+
+    def write(self, data: bytes):
+        self.size += len(data)
+        self.pending += self.compressor.compress(data)
+        while len(self.pending) >= self.chunk_size:
+            self.pass_on_chunk()
+
+    def close(self):
+        self.pending += self.compressor.flush()
+        while self.pending:
+            self.pass_on_chunk()
+
+    def pass_on_chunk(self):
+        chunk = {"job_id": self.job_id, "n": self.chunks, "encoding": "gzip",
+                 "data": bytes(self.pending[:self.chunk_size])}
+        del self.pending[:self.chunk_size]
+        self.write_chunk(chunk)
+        self.chunks += 1
+
+
+def stream_trace(job, write_chunk: Callable[[Dict], None],
+                 chunk_size: int = 255 * 1024) -> TraceChunker:
+    """
+    Download the trace of a job in compressed chunks.
+    :param job: The job, a lazy job object is sufficient.
+    :param write_chunk: Called with every chunk, from the calling thread.
+    :param chunk_size: The size of the downloaded and of the compressed chunks in bytes.
+    :return: The closed chunker, which knows the number of chunks and the uncompressed size.
+    """
+    chunker = TraceChunker(job.id, write_chunk, chunk_size)
+    job.trace(streamed=True, action=chunker.write, chunk_size=chunk_size)
+    chunker.close()
+    return chunker
+
+
+# Job attributes which have to be present in a job document. Jobs returned by
+# pipeline.jobs.list lacking one of them are fetched again with project.jobs.get
+REQUIRED_JOB_FIELDS = ("artifacts",)
+
+
+def job_document(project, pipeline_job, write_chunk: Callable[[Dict], None],
+                 trace_size_limit: int, chunk_size: int = 255 * 1024) -> Dict:
+    """
+    Convert a listed job into a document including its trace.
+    :param project: The project of the job, a lazy project object is sufficient.
+    :param pipeline_job: The job as returned by pipeline.jobs.list.
+    :param write_chunk: Called with every chunk of a trace larger than trace_size_limit.
+    :param trace_size_limit: Traces up to this size in bytes are embedded into the document,
+    larger ones are streamed in compressed chunks to write_chunk.
+    :param chunk_size: The size of the downloaded and of the compressed chunks in bytes.
+    :return: The job as dict.
+    """
+    if all(field in pipeline_job.attributes for field in REQUIRED_JOB_FIELDS):
+        job_as_dict = pipeline_job.asdict()
+    else:
+        logger.debug("Job \"%s\" listed without all required fields, fetching it", pipeline_job.id)
+        job_as_dict = project.jobs.get(pipeline_job.id).asdict()
+
+    trace_size = next((artifact["size"] for artifact in job_as_dict["artifacts"]
+                       if artifact["file_type"] == "trace"), None)
+    if trace_size is None:
+        return job_as_dict
+
+    # A lazy job object only knows its id, which is all trace() needs
+    job = project.jobs.get(pipeline_job.id, lazy=True)
+    if trace_size <= trace_size_limit:
+        job_as_dict["trace"] = job.trace().decode("utf-8")
+    else:
+        chunker = stream_trace(job, write_chunk, chunk_size)
+        job_as_dict["trace_chunks"] = chunker.chunks
+        job_as_dict["trace_encoding"] = "gzip"
+        logger.debug("Stored trace of job \"%s\" with %s bytes in %s chunks", job_as_dict["id"],
+                     chunker.size, chunker.chunks)
+    return job_as_dict
+
+
+def run_concurrently(func: Callable, items: Iterable, max_workers: int) -> Iterator:
+    """
+    Call func for every item on a pool of max_workers threads.
+    At most twice as many items as workers are in flight at any time, so items can be a lazily
+    paginated list without being fetched completely upfront.
+    :param func: The function to call with each item.
+    :param items: The items to process.
+    :param max_workers: The maximum number of concurrent calls.
+    :return: An iterator over the results in the order of the items.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = collections.deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= 2 * max_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
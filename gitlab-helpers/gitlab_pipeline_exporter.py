@@ -1,18 +1,25 @@
 # pylint: disable=C0114,C0115,C0116
 
 import abc
+import base64
+import bisect
 import datetime
 import json
 import logging
 import os
 import sys
+import time
 
 from abc import ABC
-from typing import Dict
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Tuple
 
 import gitlab
-from elasticsearch import Elasticsearch
-from pymongo import MongoClient
+from elasticsearch import Elasticsearch, helpers
+from pymongo import MongoClient, ReplaceOne
+
+from gitlab_client import RateLimiter, connect, job_document, prefetch, run_concurrently
 
 logging.basicConfig(
     level=logging.DEBUG,
@@ -31,6 +38,13 @@ def get_time(latest, offset: int = 0):
     return datetime.datetime.fromisoformat(latest) + datetime.timedelta(seconds=offset)
 
 
+def to_gitlab_time(time_to_convert: datetime.datetime) -> str:
+    """
+    Formats a datetime like the timestamps returned by GitLab, so both can be compared as strings.
+    """
+    return time_to_convert.astimezone(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
 class Sink(ABC):
 
     @abc.abstractmethod
@@ -41,19 +55,58 @@ class Sink(ABC):
     def already_added(self, document: Dict, doc_type: str) -> bool:
         pass
 
+    def sink_many(self, documents: List[Dict], doc_type: str):
+        for document in documents:
+            self.sink(document, doc_type)
+
+    def sink_trace_chunk(self, chunk: Dict, doc_type: str):
+        """
+        Stores one compressed chunk of a trace, see gitlab_client.TraceChunker. Chunks are
+        written directly from the threads downloading the traces, so implementations have to be
+        thread-safe. Sinks not supporting chunked traces ignore them.
+        """
+
     # pylint: disable=R0201
     def date_of_latest_document(self, doc_type: str, date_field_name: str = "created_at"):
         pass
 
+    # pylint: disable=R0201
+    def known_ids(self, doc_type: str, since: datetime.datetime,
+                  date_field_name: str = "created_at") -> Iterable[int] | None:
+        """
+        Returns the ids of all documents whose date field is not older than since or None if
+        the sink does not support listing ids.
+        """
+        return None
+
+    def preload_known_ids(self, doc_type: str, since: datetime.datetime):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
 
 class MongoDbSink(Sink):
 
     def __init__(self, host: str = "localhost", port: int = 27017, db_name: str = "gitlab"):
         self.mongo_client = MongoClient(f'mongodb://{host}:{port}/')
-        self.mongo_db = mongo_client[db_name]
+        self.mongo_db = self.mongo_client[db_name]
 
     def sink(self, document: Dict, doc_type: str):
-        mongo_db[doc_type].insert_one(document)
+        self.mongo_db[doc_type].insert_one(document)
+
+    def sink_many(self, documents: List[Dict], doc_type: str):
+        # Upsert by GitLab id so that re-flushing a batch does not create duplicates
+        operations = [ReplaceOne({"id": document["id"]}, document, upsert=True)
+                      for document in documents]
+        self.mongo_db[doc_type].bulk_write(operations, ordered=False)
+
+    def sink_trace_chunk(self, chunk: Dict, doc_type: str):
+        self.mongo_db[doc_type].replace_one({"job_id": chunk["job_id"], "n": chunk["n"]}, chunk,
+                                            upsert=True)
 
     def already_added(self, document: Dict, doc_type: str) -> bool:
         found_document = self.mongo_db[doc_type].find_one({"id": document["id"]})
@@ -68,7 +121,7 @@ class MongoDbSink(Sink):
         return True
 
     def date_of_latest_document(self, doc_type: str, date_field_name: str = "created_at"):
-        latest = next(self.mongo_db["jobs"].find(filter={date_field_name: {"$ne": "null"}},
+        latest = next(self.mongo_db[doc_type].find(filter={date_field_name: {"$ne": "null"}},
                                                  sort=[(date_field_name, -1)], limit=1,
                                                  projection=[date_field_name]), None)
         if latest:
@@ -79,6 +132,13 @@ class MongoDbSink(Sink):
             "No value for field \"%s\" found in collection \"%s\"", date_field_name, doc_type)
         return None
 
+    def known_ids(self, doc_type: str, since: datetime.datetime,
+                  date_field_name: str = "created_at") -> Iterable[int] | None:
+        documents = self.mongo_db[doc_type].find(
+            filter={date_field_name: {"$gte": to_gitlab_time(since)}},
+            projection={"id": 1, "_id": 0})
+        return (document["id"] for document in documents)
+
 
 class ElasticSink(Sink):
 
@@ -101,6 +161,32 @@ class ElasticSink(Sink):
     def sink(self, document: Dict, doc_type: str):
         self.es_client.index(index=doc_type, document=document)
 
+    def known_ids(self, doc_type: str, since: datetime.datetime,
+                  date_field_name: str = "created_at") -> Iterable[int] | None:
+        # A composite terms aggregation pages through all ids without fetching any document
+        composite = {"size": 10000, "sources": [{"id": {"terms": {"field": "id"}}}]}
+        while True:
+            result = self.es_client.search(
+                index=doc_type, size=0,
+                query={"range": {date_field_name: {"gte": to_gitlab_time(since)}}},
+                aggs={"ids": {"composite": composite}})
+            ids = result["aggregations"]["ids"]
+            if not ids["buckets"]:
+                return
+            yield from (bucket["key"]["id"] for bucket in ids["buckets"])
+            composite["after"] = ids["after_key"]
+
+    def sink_many(self, documents: List[Dict], doc_type: str):
+        actions = [{"_index": doc_type, "_id": document["id"], "_source": document}
+                   for document in documents]
+        helpers.bulk(self.es_client, actions)
+
+    def sink_trace_chunk(self, chunk: Dict, doc_type: str):
+        # Binary fields have to be passed base64 encoded to Elasticsearch
+        document = dict(chunk, data=base64.b64encode(chunk["data"]).decode("ascii"))
+        self.es_client.index(index=doc_type, id=f"{chunk['job_id']}-{chunk['n']}",
+                             document=document)
+
     def already_added(self, document: Dict, doc_type: str) -> bool:
         hits = \
             self.es_client.search(index=doc_type, query={"term": {"id": document["id"]}})["hits"][
@@ -117,21 +203,183 @@ class ElasticSink(Sink):
         return already_added
 
 
+class StdoutSink(Sink):
+
+    def sink(self, document: Dict, doc_type: str):
+        print(json.dumps(document, indent=2))
+
+    def already_added(self, document: Dict, doc_type: str) -> bool:
+        return False
+
+    def date_of_latest_document(self, doc_type: str, date_field_name: str = "created_at"):
+        return datetime.datetime.now(tz=datetime.timezone.utc) - datetime.timedelta(weeks=52)
+
+
+class IdCache:
+    """
+    Set of document ids. Preloaded ids are kept in a sorted array using 8 bytes per id,
+    ids added afterwards in a regular set.
+    """
+
+    def __init__(self, ids: Iterable[int] = ()):
+        self.preloaded = array("q", sorted(ids))
+        self.added = set()
+
+    def add(self, document_id: int):
+        self.added.add(document_id)
+
+    def __contains__(self, document_id: int) -> bool:
+        index = bisect.bisect_left(self.preloaded, document_id)
+        if index < len(self.preloaded) and self.preloaded[index] == document_id:
+            return True
+        return document_id in self.added
+
+    def __len__(self):
+        return len(self.preloaded) + len(self.added)
+
+
+class BufferedSink(Sink):
+    """
+    Wraps another sink and writes documents in batches using its sink_many method.
+    A batch is written as soon as it holds batch_size documents or flush_interval
+    seconds have passed since the last write. Remaining documents are written on close.
+    """
+
+    def __init__(self, sink: Sink, batch_size: int = 500, flush_interval: float = 30.0):
+        self.delegate = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffers: Dict[str, List[Dict]] = {}
+        self.known_ids_by_type: Dict[str, IdCache] = {}
+        self.last_flush = time.monotonic()
+
+    def sink(self, document: Dict, doc_type: str):
+        self.buffers.setdefault(doc_type, []).append(document)
+        if doc_type in self.known_ids_by_type:
+            self.known_ids_by_type[doc_type].add(document["id"])
+        if len(self.buffers[doc_type]) >= self.batch_size \
+                or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def already_added(self, document: Dict, doc_type: str) -> bool:
+        if doc_type in self.known_ids_by_type:
+            return document["id"] in self.known_ids_by_type[doc_type]
+        if any(buffered["id"] == document["id"] for buffered in self.buffers.get(doc_type, [])):
+            return True
+        return self.delegate.already_added(document, doc_type)
+
+    def preload_known_ids(self, doc_type: str, since: datetime.datetime):
+        """
+        Loads the ids of all documents created since the given date with a single query, so
+        that already_added no longer needs a round trip for documents of that date range.
+        """
+        ids = self.delegate.known_ids(doc_type, since)
+        if ids is None:
+            logger.debug("%s cannot list known ids", type(self.delegate).__name__)
+            return
+
+        start = time.monotonic()
+        known_ids = IdCache(ids)
+        for buffered in self.buffers.get(doc_type, []):
+            known_ids.add(buffered["id"])
+        self.known_ids_by_type[doc_type] = known_ids
+        logger.info("Preloaded %s known ids of \"%s\" from %s in %.3fs", len(known_ids), doc_type,
+                    type(self.delegate).__name__, time.monotonic() - start)
+
+    def date_of_latest_document(self, doc_type: str, date_field_name: str = "created_at"):
+        return self.delegate.date_of_latest_document(doc_type, date_field_name)
+
+    def sink_trace_chunk(self, chunk: Dict, doc_type: str):
+        self.delegate.sink_trace_chunk(chunk, doc_type)
+
+    def flush(self):
+        for doc_type, documents in self.buffers.items():
+            if not documents:
+                continue
+            start = time.monotonic()
+            self.delegate.sink_many(documents, doc_type)
+            logger.info("Wrote batch of %s documents to \"%s\" of %s in %.3fs", len(documents),
+                        doc_type, type(self.delegate).__name__, time.monotonic() - start)
+        self.buffers = {}
+        self.last_flush = time.monotonic()
+
+
+class CheckpointStore:
+    """
+    Remembers per project the id of the latest exported pipeline and the time the pipelines
+    were last listed in a local json file, so that subsequent runs only have to list pipelines
+    updated since. The listing time is used instead of the updated_at of the listed pipelines,
+    because pages are fetched lazily: a pipeline created while a long listing is in progress
+    is missing from it, yet older pipelines updated after it can still show up on later pages.
+    """
+
+    # Allows for clock skew between GitLab and the exporter
+    listing_margin = datetime.timedelta(minutes=5)
+
+    def __init__(self, path: str):
+        self.path = path
+        self.checkpoints: Dict[str, Dict] = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as checkpoint_file:
+                self.checkpoints = json.load(checkpoint_file)
+        logger.debug("Loaded %s checkpoints from %s", len(self.checkpoints), path)
+
+    def get(self, project_id) -> Dict | None:
+        return self.checkpoints.get(str(project_id))
+
+    def update(self, project_id, pipeline_ids: List[int], listing_started: datetime.datetime):
+        """
+        Record the pipelines exported by a listing started at listing_started.
+        """
+        checkpoint = self.checkpoints.setdefault(str(project_id), {"pipeline_id": 0})
+        checkpoint["pipeline_id"] = max([checkpoint["pipeline_id"]] + pipeline_ids)
+        checkpoint["updated_at"] = (listing_started - self.listing_margin).isoformat()
+
+    def save(self):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as checkpoint_file:
+            json.dump(self.checkpoints, checkpoint_file, indent=2)
+        os.replace(temp_path, self.path)
+        logger.debug("Saved %s checkpoints to %s", len(self.checkpoints), self.path)
+
+
 # Visitor pattern
 # https://refactoring.guru/design-patterns/visitor
 class GetPipelineJobsAndTraces:
 
-    def __init__(self, trace_size_limit: int, sinks: [Sink]):
+    # pylint: disable=R0913
+    def __init__(self, trace_size_limit: int, sinks: [Sink], trace_workers: int = 4,
+                 checkpoints: CheckpointStore = None, trace_chunk_size: int = 255 * 1024):
+        # Traces up to trace_size_limit bytes are embedded into the job documents, larger
+        # ones are streamed to the sinks as compressed chunks
         self.trace_size_limit = trace_size_limit
+        self.trace_chunk_size = trace_chunk_size
         self.sinks = sinks
+        self.trace_workers = trace_workers
+        self.checkpoints = checkpoints
         self.created_after = datetime.datetime.now(tz=datetime.timezone.utc) - datetime.timedelta(
             weeks=52)
         self.determine_latest_pipeline_date()
+        for sink in self.sinks:
+            sink.preload_known_ids("pipelines", self.created_after)
 
     def process(self, project):
-        pipelines_found = 0
-        for pipeline in project.pipelines.list(updated_after=self.created_after, get_all=True):
-            if not self.is_pipeline_new(pipeline):
+        self.store(project, self.fetch(project))
+
+    def fetch(self, project) -> Tuple[datetime.datetime, List[Dict]]:
+        """
+        Collects all new pipelines of the project including their jobs and traces together
+        with the time the listing started.
+        Apart from the chunks of large traces, which are written to the sinks right away by the
+        downloading threads, nothing is stored, so it is safe to call from several threads at once.
+        """
+        pipelines = []
+        listing_started = datetime.datetime.now(tz=datetime.timezone.utc)
+        checkpoint = self.checkpoints.get(project.id) if self.checkpoints else None
+        updated_after = get_time(checkpoint["updated_at"]) if checkpoint else self.created_after
+        pipelines_to_check = project.pipelines.list(updated_after=updated_after, iterator=True)
+        for pipeline in prefetch(pipelines_to_check):
+            if not self.is_pipeline_new(pipeline, checkpoint):
                 continue
 
             pipeline_as_dict = self.convert_to_dict(pipeline)
@@ -141,22 +389,35 @@ class GetPipelineJobsAndTraces:
             logger.debug(
                 "Found %s jobs for pipeline "
                 "\"%s\"", len(pipeline_as_dict['jobs']), pipeline_as_dict['id'])
+            pipelines.append(pipeline_as_dict)
 
-            self.write_to_sinks(pipeline_as_dict)
-            pipelines_found += 1
+        logger.debug("Found %s pipelines for project %s", len(pipelines), project.name)
+        return listing_started, pipelines
 
-        logger.debug("Found %s pipelines for project %s", pipelines_found, project.name)
+    def store(self, project, fetched: Tuple[datetime.datetime, List[Dict]]):
+        listing_started, pipelines = fetched
+        for pipeline_as_dict in pipelines:
+            self.write_to_sinks(pipeline_as_dict)
+        if self.checkpoints:
+            self.checkpoints.update(project.id, [pipeline["id"] for pipeline in pipelines],
+                                    listing_started)
+        logger.debug("Stored %s pipelines for project %s", len(pipelines), project.name)
 
     def write_to_sinks(self, pipeline_as_dict):
         for sink in self.sinks:
-            sink.sink(pipeline_as_dict, "pipelines")
+            if not sink.already_added(pipeline_as_dict, "pipelines"):
+                sink.sink(pipeline_as_dict, "pipelines")
 
     def add_jobs_and_traces(self, jobs, pipeline_as_dict, project):
-        for pipeline_job in jobs:
-            job = project.jobs.get(pipeline_job.id)
-            pipeline_as_dict["jobs"].append(self.add_trace(job))
-
-    def is_pipeline_new(self, pipeline):
+        with ThreadPoolExecutor(max_workers=self.trace_workers) as executor:
+            pipeline_as_dict["jobs"].extend(executor.map(
+                lambda pipeline_job: job_document(project, pipeline_job, self.write_trace_chunk,
+                                                  self.trace_size_limit, self.trace_chunk_size),
+                jobs))
+
+    def is_pipeline_new(self, pipeline, checkpoint: Dict = None):
+        if checkpoint:
+            return pipeline.id > checkpoint["pipeline_id"]
         return pipeline.created_at and get_time(pipeline.created_at) > self.created_after
 
     @staticmethod
@@ -168,7 +429,7 @@ class GetPipelineJobsAndTraces:
     def determine_latest_pipeline_date(self):
         latest_date_from_sinks = []
         for sink in self.sinks:
-            latest_date_from_sinks.append(sink.date_of_latest_document("pipeline", "created_at"))
+            latest_date_from_sinks.append(sink.date_of_latest_document("pipelines", "created_at"))
 
         applicable_date = None
         for latest_date in latest_date_from_sinks:
@@ -185,17 +446,9 @@ class GetPipelineJobsAndTraces:
         logger.debug("Determined latest pipeline date to %s", applicable_date)
         self.created_after = applicable_date
 
-    def add_trace(self, job):
-        job_as_dict = job.asdict()
-        if self.trace_exists_and_does_not_exceed_size_limit(job):
-            job_as_dict["trace"] = job.trace().decode("utf-8")
-        return job_as_dict
-
-    def trace_exists_and_does_not_exceed_size_limit(self, job):
-        for artifact in job.attributes["artifacts"]:
-            if artifact["file_type"] == "trace" and artifact["size"] <= self.trace_size_limit:
-                return True
-        return False
+    def write_trace_chunk(self, chunk: Dict):
+        for sink in self.sinks:
+            sink.sink_trace_chunk(chunk, "traces")
 
 
 gl: gitlab.Gitlab
@@ -205,32 +458,55 @@ def get_gitlab_group(group_id):
     return gl.groups.get(group_id)
 
 
-def traverse_all_projects_in_group(group_id: str, processors):
+def find_all_projects_in_group(group_id: str):
     group = get_gitlab_group(group_id)
-    for group_project in group.projects.list(get_all=True):
-        project = gl.projects.get(id=group_project.id, statistics=True)
-        for processor in processors:
-            processor.process(project)
+    yield from group.projects.list(get_all=True)
 
     for sub_group in group.subgroups.list(get_all=True):
-        traverse_all_projects_in_group(sub_group.id, processors)
+        yield from find_all_projects_in_group(sub_group.id)
+
+
+def traverse_all_projects_in_group(group_id: str, processors, max_workers: int = 1):
+    """
+    Lets every processor fetch the data of all projects in the group and its subgroups using
+    up to max_workers threads. The fetched data is stored in the same order as a serial
+    traversal would do, so apart from trace chunks, sinks are only ever written to from the
+    calling thread. Only a bounded number of projects is in flight, so the fetched data of
+    many projects does not pile up in memory behind a single slow one.
+    """
+    def fetch(group_project):
+        project = gl.projects.get(id=group_project.id, statistics=True)
+        return project, [processor.fetch(project) for processor in processors]
+
+    group_projects = find_all_projects_in_group(group_id)
+    for project, results in run_concurrently(fetch, group_projects, max_workers):
+        for processor, result in zip(processors, results):
+            processor.store(project, result)
 
 
 if __name__ == '__main__':
-    mongo_client = MongoClient('mongodb://localhost:27017/')
-    mongo_db = mongo_client['gitlab']
-
-    StdoutSink = type('StdOutSink', (Sink, object), {"sink": lambda document, doc_type: print(
-        json.dumps(document, indent=2)),
-                                 "already_added": lambda document, doc_type:
-                                 False,
-                                 "date_of_latest_document": lambda doc_type,
-                                                                   df_name: datetime.datetime.now(
-                                     tz=datetime.timezone.utc) - datetime.timedelta(
-                                     weeks=52)})
-
-    get_jobs_and_traces = GetPipelineJobsAndTraces(trace_size_limit=10000,
-                                                   sinks=[StdoutSink, MongoDbSink()])
-
-    gl = gitlab.Gitlab(url='https://gitlab.com', private_token=os.getenv("GITLAB_TOKEN"))
-    traverse_all_projects_in_group(os.getenv("GITLAB_GROUP_ID"), processors=[get_jobs_and_traces])
+    sink_batch_size = int(os.getenv("SINK_BATCH_SIZE", "500"))
+    sink_flush_interval = float(os.getenv("SINK_FLUSH_INTERVAL", "30"))
+    buffered_sinks = [BufferedSink(MongoDbSink(), sink_batch_size, sink_flush_interval)]
+
+    checkpoint_store = CheckpointStore(
+        os.getenv("CHECKPOINT_FILE", "pipeline_exporter_checkpoints.json"))
+
+    get_jobs_and_traces = GetPipelineJobsAndTraces(
+        trace_size_limit=10000, sinks=[StdoutSink()] + buffered_sinks,
+        trace_workers=int(os.getenv("TRACE_CONCURRENCY", "4")), checkpoints=checkpoint_store)
+
+    concurrency = int(os.getenv("GITLAB_CONCURRENCY", "8"))
+    # Every project worker lists jobs while a prefetch thread lists pipelines and trace_workers
+    # threads download traces, all of them need a connection of their own to keep it alive
+    pool_size = concurrency * (get_jobs_and_traces.trace_workers + 2)
+    gl = connect('https://gitlab.com', os.getenv("GITLAB_TOKEN"), pool_size=pool_size)
+    RateLimiter().install(gl.session)
+    try:
+        traverse_all_projects_in_group(os.getenv("GITLAB_GROUP_ID"),
+                                       processors=[get_jobs_and_traces], max_workers=concurrency)
+    finally:
+        for buffered_sink in buffered_sinks:
+            buffered_sink.close()
+        # Only persist the checkpoints once all documents have been written to the sinks
+        checkpoint_store.save()
@@ -1,5 +1,9 @@
 # See https://www.tensorflow.org/tutorials/keras/text_classification
+import argparse
+import json
+import shutil
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import os
@@ -9,25 +13,38 @@ import string
 from pathlib import Path
 
 import tensorflow as tf
+from elasticsearch import Elasticsearch, helpers
 from keras import layers, losses
+from pymongo import MongoClient, UpdateOne
+
+
+# The number of tokens of a trace the model sees
+sequence_length = 250
 
 
 def custom_standardization(input_data):
     lowercase = tf.strings.lower(input_data)
-    return tf.strings.regex_replace(lowercase, '[%s]' % re.escape(string.punctuation), '')
+    stripped = tf.strings.regex_replace(lowercase, '[%s]' % re.escape(string.punctuation), '')
+    # TextVectorization keeps the first sequence_length tokens, but a job reports its result at
+    # the end of its trace, so only the last tokens are passed on
+    tokens = tf.strings.split(stripped)
+    return tf.strings.reduce_join(tokens[..., -sequence_length:], axis=-1, separator=' ')
 
 
 custom_objects = {"custom_standardization": custom_standardization}
 
+# text_dataset_from_directory assigns the labels in alphabetical order of the class folders
+class_names = ["failed", "success"]
+
 
 def create_model(model_path, train_data_folder, test_data_folder):
-    batch_size = 32
     seed = 42
 
+    # The datasets are batched by train_model, after they have been cached
     data_dir = train_data_folder
     raw_train_ds = tf.keras.utils.text_dataset_from_directory(
         data_dir,
-        batch_size=batch_size,
+        batch_size=None,
         validation_split=0.2,
         subset='training',
         seed=seed)
@@ -37,7 +54,7 @@ def create_model(model_path, train_data_folder, test_data_folder):
 
     raw_val_ds = tf.keras.utils.text_dataset_from_directory(
         data_dir,
-        batch_size=batch_size,
+        batch_size=None,
         validation_split=0.2,
         subset='validation',
         seed=seed,
@@ -45,10 +62,62 @@ def create_model(model_path, train_data_folder, test_data_folder):
 
     raw_test_ds = tf.keras.utils.text_dataset_from_directory(
         test_data_folder,
-        batch_size=batch_size)
+        batch_size=None)
+
+    train_model(model_path, raw_train_ds, raw_val_ds, raw_test_ds)
+
+
+def read_labeled_traces_from_mongo(pipelines_collection, max_trace_length):
+    """
+    Read the embedded traces of all failed and successful jobs. Only the tail of long traces is
+    kept, since that is where a job reports its result.
+    :return: Generator of (job id, trace, label) tuples.
+    """
+    query = {"jobs": {"$elemMatch": {"trace": {"$exists": True}, "status": {"$in": class_names}}}}
+    projection = ["jobs.id", "jobs.trace", "jobs.status"]
+    for pipeline in pipelines_collection.find(query, projection=projection):
+        for job in pipeline["jobs"]:
+            if "trace" in job and job.get("status") in class_names:
+                yield job["id"], job["trace"][-max_trace_length:], class_names.index(job["status"])
+
+
+def create_model_from_mongo(model_path, mongo_url, cache_dir, max_trace_length, batch_size=32):
+    """
+    Train the model on the traces exported to the pipelines collection by the exporters instead of
+    a folder structure. Traces are streamed from mongo and split by job id into 80% training,
+    10% validation and 10% test data.
+    """
+    def dataset(split):
+        def labeled_traces():
+            pipelines = MongoClient(mongo_url)["gitlab"]["pipelines"]
+            for job_id, trace, label in read_labeled_traces_from_mongo(pipelines, max_trace_length):
+                if split(job_id % 10):
+                    yield trace, label
+
+        return tf.data.Dataset.from_generator(labeled_traces, output_signature=(
+            tf.TensorSpec(shape=(), dtype=tf.string), tf.TensorSpec(shape=(), dtype=tf.int32)))
+
+    raw_train_ds = dataset(lambda remainder: remainder < 8)
+    raw_val_ds = dataset(lambda remainder: remainder == 8)
+    raw_test_ds = dataset(lambda remainder: remainder == 9)
+    train_model(model_path, raw_train_ds, raw_val_ds, raw_test_ds, cache_dir, batch_size)
+
+
+def train_model(model_path, raw_train_ds, raw_val_ds, raw_test_ds, cache_dir=None, batch_size=32):
+    """
+    Train, evaluate and save the model. The raw training texts and the vectorized training and
+    validation data are cached, in memory or in files in cache_dir, so every trace is only read
+    and tokenized once. The datasets are expected unbatched, the training data is shuffled after
+    the cache, so every epoch sees a different order.
+    """
+    if cache_dir:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        os.makedirs(cache_dir)
+
+    def cache(dataset, name):
+        return dataset.cache(f"{cache_dir}/{name}" if cache_dir else "")
 
     max_features = 10000
-    sequence_length = 250
 
     vectorize_layer = layers.TextVectorization(
         standardize=custom_standardization,
@@ -56,25 +125,28 @@ def create_model(model_path, train_data_folder, test_data_folder):
         output_mode='int',
         output_sequence_length=sequence_length)
 
-    train_text = raw_train_ds.map(lambda x, y: x)
+    raw_train_ds = cache(raw_train_ds, "raw_train")
+    train_text = raw_train_ds.map(lambda x, y: x).batch(batch_size)
     vectorize_layer.adapt(train_text)
 
     def vectorize_text(text, label):
         text = tf.expand_dims(text, -1)
         return vectorize_layer(text), label
 
-    text_batch, label_batch = next(iter(raw_train_ds))
-    first_trace, first_label = text_batch[0], label_batch[0]
+    first_trace, first_label = next(iter(raw_train_ds))
     print("Trace", first_trace)
-    print("Label", raw_train_ds.class_names[first_label])
+    print("Label", class_names[first_label])
     print("Vectorized trace", vectorize_text(first_trace, first_label))
 
     print('Vocabulary size: {}'.format(len(vectorize_layer.get_vocabulary())))
 
-    train_ds = raw_train_ds.map(vectorize_text)
-    val_ds = raw_val_ds.map(vectorize_text)
-    test_ds = raw_test_ds.map(vectorize_text)
+    def vectorize(dataset):
+        return dataset.batch(batch_size).map(vectorize_text, num_parallel_calls=tf.data.AUTOTUNE)
 
+    train_ds = cache(vectorize(raw_train_ds).unbatch(), "train").shuffle(
+        10000, seed=42, reshuffle_each_iteration=True).batch(batch_size).prefetch(tf.data.AUTOTUNE)
+    val_ds = cache(vectorize(raw_val_ds), "validation").prefetch(tf.data.AUTOTUNE)
+    test_ds = vectorize(raw_test_ds).prefetch(tf.data.AUTOTUNE)
     embedding_dim = 16
     model = tf.keras.Sequential([
         layers.Embedding(max_features + 1, embedding_dim),
@@ -111,19 +183,203 @@ def create_model(model_path, train_data_folder, test_data_folder):
     export_model.save(model_path)
 
 
+# The GitLab runner finishes every trace with one of these lines (possibly wrapped in ANSI colour
+# codes), so most traces can be labeled without asking the model
+result_line_pattern = re.compile(r"(?P<failed>ERROR: Job failed)|(?P<success>Job succeeded)")
+result_line_search_length = 2000
+
+
+def classify_by_result_line(trace):
+    """
+    Label a trace by the last result line the runner wrote to its tail.
+    :return: The label or None if the trace does not contain a result line.
+    """
+    label = None
+    for match in result_line_pattern.finditer(trace, max(len(trace) - result_line_search_length, 0)):
+        label = match.lastgroup
+    return label
+
+
+def classify(trace_model, records, batch_size=256, fast_path=True):
+    """
+    Classify traces in batches. Traces whose result line decides the label skip the model and
+    their labels are returned right away, the others are batched. A batch is predicted on a
+    background thread while the traces of the next batch are read.
+    :param trace_model: The loaded trace model.
+    :param records: Iterable of (key, trace) tuples. The key is passed through unchanged.
+    :param batch_size: The number of traces predicted at once.
+    :param fast_path: Whether to label traces by their result line where possible.
+    :return: Generator of (key, label) tuples, not necessarily in the order of the records.
+    """
+    total = 0
+    fast_path_hits = 0
+    keys = []
+    traces = []
+    predicting = None
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        for key, trace in records:
+            total += 1
+            if fast_path and (label := classify_by_result_line(trace)):
+                fast_path_hits += 1
+                yield key, label
+                continue
+            keys.append(key)
+            traces.append(trace)
+            if len(traces) >= batch_size:
+                if predicting:
+                    yield from predicted_labels(*predicting)
+                predicting = keys, executor.submit(trace_model.predict_on_batch, tf.constant(traces))
+                keys, traces = [], []
+
+        if predicting:
+            yield from predicted_labels(*predicting)
+        if traces:
+            predicting = keys, executor.submit(trace_model.predict_on_batch, tf.constant(traces))
+            yield from predicted_labels(*predicting)
+
+    if fast_path and total:
+        print(f"Fast path labeled {fast_path_hits} of {total} traces "
+              f"({fast_path_hits / total:.1%})", file=sys.stderr)
+
+
+def predicted_labels(keys, predictions):
+    for key, prediction in zip(keys, predictions.result()[:, 0]):
+        yield key, class_names[int(prediction > 0.5)]
+
+
+def read_unlabeled_traces_from_mongo(pipelines_collection, max_trace_length):
+    # Only the tail of a trace is classified, like the model was trained on
+    query = {"jobs": {"$elemMatch": {"trace": {"$exists": True}, "trace_label": {"$exists": False}}}}
+    projection = ["jobs.id", "jobs.trace", "jobs.trace_label"]
+    for pipeline in pipelines_collection.find(query, projection=projection):
+        for job in pipeline["jobs"]:
+            if "trace" in job and "trace_label" not in job:
+                yield (pipeline["_id"], job["id"]), job["trace"][-max_trace_length:]
+
+
+def write_labels_to_mongo(pipelines_collection, labels, batch_size):
+    updates = []
+    for (pipeline_id, job_id), label in labels:
+        updates.append(UpdateOne({"_id": pipeline_id}, {"$set": {"jobs.$[job].trace_label": label}},
+                                 array_filters=[{"job.id": job_id}]))
+        if len(updates) >= batch_size:
+            pipelines_collection.bulk_write(updates, ordered=False)
+            print(f"Labeled {len(updates)} traces")
+            updates = []
+    if updates:
+        pipelines_collection.bulk_write(updates, ordered=False)
+        print(f"Labeled {len(updates)} traces")
+
+
+def read_unlabeled_traces_from_elastic(es_client, max_trace_length):
+    # The jobs of a pipeline document are not indexed as nested objects, so the unlabeled ones
+    # are picked client side from every pipeline with a trace
+    query = {"exists": {"field": "jobs.trace"}}
+    source = ["jobs.id", "jobs.trace", "jobs.trace_label"]
+    for hit in helpers.scan(es_client, index="pipelines", query={"query": query}, _source=source):
+        for job in hit["_source"]["jobs"]:
+            if "trace" in job and "trace_label" not in job:
+                yield (hit["_id"], job["id"]), job["trace"][-max_trace_length:]
+
+
+# Sets the labels, given by job id, on the jobs of a pipeline document
+set_trace_labels_script = """
+for (job in ctx._source.jobs) {
+    String label = params.labels[String.valueOf(job.id)];
+    if (label != null) {
+        job.trace_label = label;
+    }
+}
+"""
+
+
+def write_labels_to_elastic(es_client, labels, batch_size):
+    def flush(labels_by_pipeline):
+        actions = [{"_op_type": "update", "_index": "pipelines", "_id": pipeline_id,
+                    "script": {"source": set_trace_labels_script, "params": {"labels": job_labels}}}
+                   for pipeline_id, job_labels in labels_by_pipeline.items()]
+        helpers.bulk(es_client, actions)
+        print(f"Labeled {sum(len(job_labels) for job_labels in labels_by_pipeline.values())} traces")
+
+    # The labels of a pipeline are collected, so its document is updated once per batch
+    labels_by_pipeline = {}
+    pending = 0
+    for (pipeline_id, job_id), label in labels:
+        labels_by_pipeline.setdefault(pipeline_id, {})[str(job_id)] = label
+        pending += 1
+        if pending >= batch_size:
+            flush(labels_by_pipeline)
+            labels_by_pipeline = {}
+            pending = 0
+    if labels_by_pipeline:
+        flush(labels_by_pipeline)
+
+
+def read_traces_from_stdin(max_trace_length):
+    # One JSON object per line with at least the fields "id" and "trace"
+    for line in sys.stdin:
+        if line.strip():
+            job = json.loads(line)
+            yield job["id"], job["trace"][-max_trace_length:]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Train and apply a model classifying GitLab job traces')
+    parser.add_argument('data_dir', nargs='?', help='Folder containing the train and test folders, '
+                                                    'only required if the model has to be trained')
+    parser.add_argument('--classify', choices=['mongo', 'elastic', 'stdin'],
+                        help='Label traces read from the pipelines collection in mongo, the pipelines index in '
+                             'elasticsearch or as JSON lines from stdin')
+    parser.add_argument('--batch-size', type=int, default=256, help='The number of traces predicted at once')
+    parser.add_argument('--no-fast-path', action='store_true',
+                        help='Let the model label all traces, even those with a runner result line')
+    parser.add_argument('--mongo-url', default='mongodb://localhost:27017/', help='The mongo db to read from')
+    parser.add_argument('--elastic-url', default='http://localhost:9200', help='The elasticsearch to read from')
+    parser.add_argument('--train-from-mongo', action='store_true',
+                        help='Train the model on the traces in the pipelines collection instead of data_dir')
+    parser.add_argument('--cache-dir', help='Folder for the training data cache, cached in memory if not set')
+    parser.add_argument('--max-trace-length', type=int, default=4000,
+                        help='Only the last characters of a trace read from mongo are used for training, '
+                             'only the last characters of a trace to classify are classified')
+    return parser.parse_args()
+
+
 if __name__ == '__main__':
+    args = parse_args()
     tf.config.set_visible_devices([], 'GPU')
     model_path = os.path.dirname(os.path.realpath(__file__)) + "/model/trace_model"
     trace_model = None
-    data_dir = sys.argv[1]
+    data_dir = args.data_dir
     if not os.path.isdir(model_path):
-        create_model(model_path, data_dir + "/train", data_dir + "/test")
+        if args.train_from_mongo:
+            create_model_from_mongo(model_path, args.mongo_url, args.cache_dir, args.max_trace_length)
+        elif not data_dir:
+            sys.exit(f"No model found in {model_path}, data_dir is required to train one")
+        else:
+            create_model(model_path, data_dir + "/train", data_dir + "/test")
 
     trace_model = tf.keras.models.load_model(model_path, custom_objects=custom_objects)
 
-    samples_to_predict = np.array(
-        ["success", "failed", "I Failed my vocabulary test", "Success is not an option"])
-
-    predictions = trace_model.predict(samples_to_predict, verbose=2)
-    test = (predictions > 0.5).astype('int32')
-    print(test)
+    if args.classify == 'mongo':
+        pipelines = MongoClient(args.mongo_url)["gitlab"]["pipelines"]
+        unlabeled_traces = read_unlabeled_traces_from_mongo(pipelines, args.max_trace_length)
+        labels = classify(trace_model, unlabeled_traces, args.batch_size, not args.no_fast_path)
+        write_labels_to_mongo(pipelines, labels, args.batch_size)
+    elif args.classify == 'elastic':
+        es_client = Elasticsearch(args.elastic_url)
+        unlabeled_traces = read_unlabeled_traces_from_elastic(es_client, args.max_trace_length)
+        labels = classify(trace_model, unlabeled_traces, args.batch_size, not args.no_fast_path)
+        write_labels_to_elastic(es_client, labels, args.batch_size)
+    elif args.classify == 'stdin':
+        traces_to_classify = read_traces_from_stdin(args.max_trace_length)
+        for job_id, label in classify(trace_model, traces_to_classify, args.batch_size,
+                                      not args.no_fast_path):
+            print(json.dumps({"id": job_id, "label": label}), flush=True)
+    else:
+        samples_to_predict = np.array(
+            ["success", "failed", "I Failed my vocabulary test", "Success is not an option"])
+
+        predictions = trace_model.predict(samples_to_predict, verbose=2)
+        test = (predictions > 0.5).astype('int32')
+        print(test)
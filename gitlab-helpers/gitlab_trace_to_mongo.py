@@ -1,10 +1,21 @@
 """
 A simple script that exports a GitLab pipeline its jobs and traces (API objects) to a mongo db.
+Traces larger than TRACE_SIZE_LIMIT are not embedded into the job but streamed gzip compressed
+in chunks of TRACE_CHUNK_SIZE bytes to the "traces" collection, linked by job_id.
+Jobs and traces are collected concurrently by JOB_CONCURRENCY workers sharing one pooled session.
 """
 import os
-from gitlab import Gitlab
+import time
+
 from pymongo import MongoClient
 
+import gitlab_client
+
+
+def write_trace_chunk(traces_collection, chunk):
+    traces_collection.replace_one({"job_id": chunk["job_id"], "n": chunk["n"]}, chunk, upsert=True)
+
+
 if __name__ == '__main__':
     mongo_client = MongoClient(f"mongodb://{os.getenv('MONGO_DB_HOST', 'mongodb')}:27017/")
     mongo_db = mongo_client["gitlab"]
@@ -16,25 +27,30 @@ if __name__ == '__main__':
     project_id = os.getenv("CI_PROJECT_ID")
     pipeline_id = os.getenv("CI_PIPELINE_ID")
     trace_size_limit = int(os.getenv("TRACE_SIZE_LIMIT", "1000000"))
+    trace_chunk_size = int(os.getenv("TRACE_CHUNK_SIZE", str(255 * 1024)))
+    job_concurrency = int(os.getenv("JOB_CONCURRENCY", "8"))
 
-    gitlab = Gitlab(url=gitlab_url, private_token=private_token)
+    gitlab = gitlab_client.connect(gitlab_url, private_token, pool_size=job_concurrency)
 
-    project = gitlab.projects.get(id=project_id)
+    project = gitlab.projects.get(id=project_id, lazy=True)
     pipeline = project.pipelines.get(id=pipeline_id)
-    collected_jobs = []
-
-    print(f"Collecting jobs and trace logs for pipeline {pipeline.id} of project {project.id}")
-    for pipeline_job in pipeline.jobs.list(get_all=True):
-        complete_job = project.jobs.get(pipeline_job.id)
-        job_as_dict = complete_job.asdict()
-
-        for artifact in complete_job.attributes["artifacts"]:
-            if artifact["file_type"] == "trace" and artifact["size"] <= trace_size_limit:
-                job_as_dict["trace"] = complete_job.trace().decode("utf-8")
-
-        collected_jobs.append(job_as_dict)
 
-    print(f"Found {len(collected_jobs)} jobs and traces for pipeline {pipeline.id}")
+    print(f"Collecting jobs and trace logs for pipeline {pipeline.id} of project {project_id}")
+    phase_start = time.monotonic()
+    pipeline_jobs = pipeline.jobs.list(get_all=True)
+    print(f"Listed {len(pipeline_jobs)} jobs in {time.monotonic() - phase_start:.2f}s")
+
+    phase_start = time.monotonic()
+    collected_jobs = list(gitlab_client.run_concurrently(
+        lambda pipeline_job: gitlab_client.job_document(
+            project, pipeline_job, lambda chunk: write_trace_chunk(mongo_db["traces"], chunk),
+            trace_size_limit, trace_chunk_size),
+        pipeline_jobs, job_concurrency))
+    print(f"Found {len(collected_jobs)} jobs and traces for pipeline {pipeline.id} "
+          f"in {time.monotonic() - phase_start:.2f}s")
+
+    phase_start = time.monotonic()
     pipeline_as_dict = pipeline.asdict()
     pipeline_as_dict["jobs"] = collected_jobs
     mongo_db["pipelines"].insert_one(pipeline_as_dict)
+    print(f"Stored pipeline {pipeline.id} in {time.monotonic() - phase_start:.2f}s")
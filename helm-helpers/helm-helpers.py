@@ -1,28 +1,82 @@
 import argparse
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+import functools
+from concurrent.futures import FIRST_EXCEPTION, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from dataclasses import dataclass
+import hashlib
 import json
 import glob
 import os
+import pickle
 import re
 import shutil
 import subprocess
-from typing import Dict
+import threading
+import time
+from typing import Dict, List, Tuple
 import yaml
 
+from helm_repositories import add_repositories, repository_name
+
 
 REPO_URL_MAPPING = {}
 
+class StepTimings:
+    """
+    Accumulates the time spent in each step of rendering a helm release, across all threads.
+    """
+
+    def __init__(self):
+        self.durations: Dict[Tuple[str, str], float] = defaultdict(float)
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def measure(self, release_name, step):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.durations[release_name, step] += time.perf_counter() - start
+
+    def print_summary(self, slowest=10):
+        per_step = defaultdict(float)
+        per_release = defaultdict(float)
+        for (release_name, step), duration in self.durations.items():
+            per_step[step] += duration
+            per_release[release_name] += duration
+        print("Time spent per step:")
+        for step, duration in sorted(per_step.items(), key=lambda step_and_duration: -step_and_duration[1]):
+            print(f"  {step}: {duration:.1f}s")
+        print(f"Slowest {slowest} helm releases:")
+        slowest_releases = sorted(per_release.items(), key=lambda name_and_duration: -name_and_duration[1])[:slowest]
+        for release_name, duration in slowest_releases:
+            steps = ", ".join(f"{step} {self.durations[release_name, step]:.1f}s" for step in per_step
+                              if (release_name, step) in self.durations)
+            print(f"  {release_name}: {duration:.1f}s ({steps})")
+
+
+STEP_TIMINGS = StepTimings()
+
 
 def to_string(obj):
     return obj.__class__.__name__ + "/" + obj.name
 
 
+@functools.lru_cache(maxsize=None)
+def compile_path(element) -> tuple:
+    """
+    Split a path like spec/valuesFrom/[0]/name into its keys once, list indices are converted to ints.
+    """
+    return tuple(int(re.search(r'\d+', key).group()) if re.search(r'[\d+]', key) else key
+                 for key in element.split('/'))
+
+
 def find(element, dictionary):
     current_dictionary = dictionary
-    for key in element.split('/'):
-        if re.search(r'[\d+]', key):
-            key = int(re.search(r'\d+', key).group())
-        elif key not in current_dictionary.keys():
+    for key in compile_path(element):
+        if type(key) is str and key not in current_dictionary.keys():
             return None
         current_dictionary = current_dictionary[key]
     return current_dictionary
@@ -31,6 +85,11 @@ def find(element, dictionary):
 @dataclass
 class FluxObject:
     name: str = None
+    namespace: str = None
+
+    @property
+    def key(self) -> Tuple[str, str, str]:
+        return self.__class__.__name__, self.namespace, self.name
 
     def __str__(self):
         return to_string(self)
@@ -63,14 +122,19 @@ class HelmConfigValues(FluxObject):
 @dataclass
 class HelmRelease(FluxObject):
     chart: str = None
+    version: str = None
     repo: GitRepository = None
     repo_name: str = None
+    repo_namespace: str = None
     values: HelmConfigValues = None
     values_config_map_name: str = None
+    # Name of the folder and manifests file of the rendered release, see FluxObjectGraph.name_outputs
+    output_name: str = None
 
 
 def build_git_repository(yaml_block) -> GitRepository:
-    repo = GitRepository(name=find("metadata/name", yaml_block), url=find("spec/url", yaml_block))
+    repo = GitRepository(name=find("metadata/name", yaml_block), namespace=find("metadata/namespace", yaml_block),
+                         url=find("spec/url", yaml_block))
     repo.tag = get_git_repository_tag(yaml_block)
     return repo
 
@@ -92,7 +156,7 @@ def build_helm_repository(yaml_block) -> GitRepository:
     substitute_url = get_substitute_url(name)
     if substitute_url:
         url = substitute_url
-    repo = HelmRepository(name=name, url=url)
+    repo = HelmRepository(name=name, namespace=find("metadata/namespace", yaml_block), url=url)
     return repo
 
 
@@ -103,33 +167,128 @@ def get_git_repository_tag(yaml_block) -> str:
 
 
 def build_helm_release(yaml_block) -> HelmRelease:
-    hr = HelmRelease(name=find("metadata/name", yaml_block), chart=find("spec/chart/spec/chart", yaml_block),
+    hr = HelmRelease(name=find("metadata/name", yaml_block), namespace=find("metadata/namespace", yaml_block),
+                     chart=find("spec/chart/spec/chart", yaml_block),
+                     version=find("spec/chart/spec/version", yaml_block),
                      repo_name=find("spec/chart/spec/sourceRef/name", yaml_block),
+                     repo_namespace=find("spec/chart/spec/sourceRef/namespace", yaml_block),
                      values_config_map_name=find("spec/valuesFrom/[0]/name", yaml_block))
     if "values" in yaml_block["spec"]:
-        hr.values = HelmConfigValues(find("metadata/name", yaml_block), yaml.dump(find("spec/values", yaml_block)))
+        hr.values = HelmConfigValues(name=find("metadata/name", yaml_block), namespace=hr.namespace,
+                                     values=yaml.dump(find("spec/values", yaml_block)))
     return hr
 
 
 def build_helm_values(yaml_block) -> HelmConfigValues | None:
     if "values.yaml" not in yaml_block["data"]:
         return None
-    return HelmConfigValues(find("metadata/name", yaml_block), find("data/values.yaml", yaml_block))
+    return HelmConfigValues(name=find("metadata/name", yaml_block), namespace=find("metadata/namespace", yaml_block),
+                            values=find("data/values.yaml", yaml_block))
 
 
 Kind2Builder = {"GitRepository": build_git_repository, "HelmRepository": build_helm_repository,
                 "HelmRelease": build_helm_release, "ConfigMap": build_helm_values}
 
 
-def create_flux_objects_from_files(glob_pattern) -> Dict[str, object]:
+# The libyaml based loader is an order of magnitude faster than the pure python one, if available
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+DOCUMENT_START = re.compile(r'^---(?=\s|$)', re.MULTILINE)
+TOP_LEVEL_KIND = re.compile(r'^kind:[ \t]*["\']?([\w.-]+)', re.MULTILINE)
+
+
+class ManifestCache:
+    """
+    Flux objects built from each manifest file in a previous run, keyed by the path of the file and
+    valid as long as its size and modification time are unchanged. The cache is discarded as a whole
+    when this script changes, since the pickled objects might no longer match its classes, or when the
+    helm repository url mapping changes.
+    """
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        # Helm repository urls are substituted from the url mapping while the objects are built
+        version = hashlib.sha256()
+        for file in (__file__, f"{os.path.dirname(__file__)}/helm_repo_url_mapping.json"):
+            with open(file, 'rb') as file_stream:
+                version.update(file_stream.read())
+        self.version = version.hexdigest()
+        self.entries = {}
+        try:
+            with open(cache_file, 'rb') as cache_stream:
+                version, entries = pickle.load(cache_stream)
+            if version == self.version:
+                self.entries = entries
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError, AttributeError, ValueError):
+            pass
+
+    @staticmethod
+    def signature(file) -> Tuple[int, int]:
+        file_stat = os.stat(file)
+        return file_stat.st_size, file_stat.st_mtime_ns
+
+    def get(self, file):
+        if (entry := self.entries.get(file)) and entry[0] == self.signature(file):
+            return entry[1]
+        return None
+
+    def save(self, objects_per_file: Dict[str, Dict[tuple, FluxObject]]):
+        """
+        Replace the cache with the objects of the given files, which drops the entries of deleted files.
+        """
+        entries = {file: (self.signature(file), file_objects) for file, file_objects in objects_per_file.items()}
+        with open(self.cache_file + ".tmp", 'wb') as cache_stream:
+            pickle.dump((self.version, entries), cache_stream, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(self.cache_file + ".tmp", self.cache_file)
+        self.entries = entries
+
+
+def create_flux_objects_from_files(glob_pattern, processes=None,
+                                   manifest_cache: ManifestCache = None) -> Dict[tuple, FluxObject]:
+    files = glob.glob(glob_pattern, recursive=True)
+    objects_per_file = {file: manifest_cache.get(file) if manifest_cache else None for file in files}
+    changed_files = [file for file, file_objects in objects_per_file.items() if file_objects is None]
+    if manifest_cache:
+        print(f"Parsing {len(changed_files)} of {len(files)} manifests, all others are unchanged")
+
+    if processes == 1 or len(changed_files) < 2:
+        parsed_objects = map(create_flux_objects_from_file, changed_files)
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            parsed_objects = list(executor.map(create_flux_objects_from_file, changed_files, chunksize=16))
+    objects_per_file.update(zip(changed_files, parsed_objects))
+
+    # Saved before the objects are linked to each other when the helm releases are composed
+    if manifest_cache:
+        manifest_cache.save(objects_per_file)
+
+    # Merged in the order of the files, so a later object still replaces an earlier one with the same name
+    created_objects = {}
+    for file_objects in objects_per_file.values():
+        created_objects.update(file_objects)
+    return created_objects
+
+
+def create_flux_objects_from_file(file) -> Dict[tuple, FluxObject]:
     created_objects = {}
-    for file in glob.glob(glob_pattern, recursive=True):
-        with open(file, 'r') as file_stream:
-            yaml_docs = yaml.load_all(file_stream, Loader=yaml.FullLoader)
-            create_flux_objects_from_yaml_doc(created_objects, yaml_docs)
+    create_flux_objects_from_yaml_doc(created_objects, load_relevant_yaml_docs(file))
     return created_objects
 
 
+def load_relevant_yaml_docs(file):
+    """
+    Load the yaml documents of a file, skipping documents whose kind has no builder without constructing them.
+    Documents whose kind cannot be found by a plain text scan are loaded and handled as before.
+    """
+    with open(file, 'r') as file_stream:
+        content = file_stream.read()
+    for document in DOCUMENT_START.split(content):
+        if (kind := TOP_LEVEL_KIND.search(document)) and kind.group(1) not in Kind2Builder.keys():
+            print(f"Could not find builder for kind {kind.group(1)} in {file}")
+            continue
+        yield from yaml.load_all(document, Loader=YamlLoader)
+
+
 def create_flux_objects_from_yaml_doc(created_objects, yaml_docs):
     for yaml_doc in yaml_docs:
         if not (kind := find("kind", yaml_doc)):
@@ -145,30 +304,63 @@ def create_flux_object_from_yaml_doc(created_objects, kind, yaml_doc):
     if not (flux_object := builder(yaml_doc)):
         print(f"Could not build flux object from {yaml_doc!s:200.200}...")
     else:
-        created_objects[str(flux_object)] = flux_object
-
-
-def compose_helm_releases(flux_objects):
-    for release in {name: flux_object for name, flux_object in flux_objects.items() if
-                    isinstance(flux_object, HelmRelease)}.values():  # type: HelmRelease
-        try:
-            release.repo = flux_objects[GitRepository.__name__ + "/" + release.repo_name]
-        except KeyError:
-            pass
-
-        try:
-            release.repo = flux_objects[HelmRepository.__name__ + "/" + release.repo_name]
-        except KeyError:
-            pass
-
+        created_objects[flux_object.key] = flux_object
+
+
+class FluxObjectGraph:
+    """
+    Index of flux objects by (kind, namespace, name), which resolves the repository and the values config map
+    of every helm release. Objects whose manifests do not specify a namespace, e.g. because it is set by a
+    kustomization, are found by kind and name only.
+    """
+
+    def __init__(self, flux_objects):
+        self.objects: Dict[tuple, FluxObject] = {}
+        self.objects_by_name: Dict[tuple, FluxObject] = {}
+        for flux_object in flux_objects:
+            self.objects[flux_object.key] = flux_object
+            self.objects_by_name[flux_object.__class__.__name__, flux_object.name] = flux_object
+        for release in self.helm_releases():
+            self.resolve(release)
+        self.name_outputs()
+
+    def get(self, kind, name, namespace=None) -> FluxObject | None:
+        if flux_object := self.objects.get((kind.__name__, namespace, name)):
+            return flux_object
+        return self.objects_by_name.get((kind.__name__, name))
+
+    def helm_releases(self) -> List[HelmRelease]:
+        return [flux_object for flux_object in self.objects.values() if isinstance(flux_object, HelmRelease)]
+
+    def name_outputs(self):
+        """
+        Releases are rendered to files named after them. Releases sharing their name with a release in
+        another namespace are prefixed with their namespace, so they do not overwrite each other.
+        """
+        releases = self.helm_releases()
+        release_names = Counter(release.name for release in releases)
+        for release in releases:
+            if release_names[release.name] > 1 and release.namespace:
+                release.output_name = f"{release.namespace}-{release.name}"
+            else:
+                release.output_name = release.name
+
+    def resolve(self, release: HelmRelease):
+        repo_namespace = release.repo_namespace or release.namespace
+        release.repo = self.get(HelmRepository, release.repo_name, repo_namespace) or \
+            self.get(GitRepository, release.repo_name, repo_namespace)
         assert release.repo, f"Could not find repository with name {release.repo_name}"
 
         if not release.values:
-            release.values = flux_objects[HelmConfigValues.__name__ + "/" + release.values_config_map_name]
-        yield release
+            release.values = self.get(HelmConfigValues, release.values_config_map_name, release.namespace)
+            assert release.values, f"Could not find config map with name {release.values_config_map_name}"
+
+
+def compose_helm_releases(flux_objects):
+    return FluxObjectGraph(flux_objects.values()).helm_releases()
 
 
-def get_chart_dependency_repos(path_to_chart: str):
+def get_chart_dependency_repo_urls(path_to_chart: str):
     helm_chart = None
     with open(f'{path_to_chart}/Chart.yaml', 'r') as chart_file:
         helm_chart = yaml.load(chart_file, Loader=yaml.FullLoader)
@@ -176,19 +368,12 @@ def get_chart_dependency_repos(path_to_chart: str):
     if dependencies:
         for dependency in dependencies:
             if "repository" in dependency:
-                yield dependency["name"], dependency["repository"]
-
-
-def add_chart_repositories(repo_list) -> bool:
-    at_least_one_repo = False
-    for repo in repo_list:
-        subprocess.run(['helm', 'repo', 'add', repo[0], repo[1]], check=True)
-        at_least_one_repo = True
-    return at_least_one_repo
+                yield dependency["repository"]
 
 
 def build_chart_dependencies(path_to_chart):
-    subprocess.run(['helm', 'dependency', 'build', path_to_chart], check=True)
+    # The indexes of all dependency repositories were just refreshed when they were added
+    subprocess.run(['helm', 'dependency', 'build', '--skip-refresh', path_to_chart], check=True)
 
 
 def parse_args():
@@ -196,6 +381,22 @@ def parse_args():
     parser.add_argument('--base-dir', '-b', nargs='?', dest="base_path", required=True,
                         help='Path to folder containing the flux manifests')
     parser.add_argument('--work-dir', '-w', nargs='?', dest="work_dir", required=True, help='Path to working directory')
+    parser.add_argument('--jobs', '-j', type=int, default=1, dest="jobs",
+                        help='Number of helm releases rendered in parallel')
+    parser.add_argument('--cache-dir', '-c', dest="cache_dir",
+                        help='Path to a chart cache reused across runs, must be outside the working directory')
+    parser.add_argument('--cache-max-size', type=int, default=2048, dest="cache_max_size",
+                        help='Size in MiB above which the least recently used cache entries are removed')
+    parser.add_argument('--parse-jobs', type=int, dest="parse_jobs",
+                        help='Number of processes parsing the flux manifests, defaults to the number of CPUs')
+    parser.add_argument('--manifest-cache', '-m', dest="manifest_cache",
+                        help='Path to a file caching the parsed flux manifests, only changed manifests are '
+                             'parsed again')
+    parser.add_argument('--helm-debug', action='store_true', dest="helm_debug",
+                        help='Pass --debug to helm template')
+    parser.add_argument('--incremental', '-i', action='store_true', dest="incremental",
+                        help='Only render helm releases whose inputs changed since the last run in the working '
+                             'directory and reuse the previously generated manifests of all others')
 
     arguments = parser.parse_args()
     return arguments
@@ -209,40 +410,301 @@ def recreate_folder(folder):
     os.mkdir(folder)
 
 
+class ChartCache:
+    """
+    Content addressed cache of fetched charts and git repositories, shared by all releases referencing
+    the same source. Entries are keyed by the repository url and the resolved revision, i.e. the commit
+    of a git ref or the exact chart version, and are evicted least recently used first.
+    """
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.key_locks = defaultdict(threading.Lock)
+        self.key_locks_lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, key, fetch):
+        """
+        Return the folder of the cache entry for key, calling fetch with a target folder to create it
+        if it does not exist yet. Releases requesting the same key concurrently wait for one fetch.
+        fetch may return a different key if what it fetched turns out not to match the requested key,
+        e.g. because a branch moved in the meantime, the entry is stored under that key then.
+        """
+        entry = f"{self.cache_dir}/{key}"
+        with self.key_locks_lock:
+            key_lock = self.key_locks[key]
+        with key_lock:
+            if os.path.isdir(entry):
+                print(f"Using cached chart source {entry}")
+            else:
+                incomplete_entry = entry + ".incomplete"
+                shutil.rmtree(incomplete_entry, ignore_errors=True)
+                entry = f"{self.cache_dir}/{fetch(incomplete_entry) or key}"
+                try:
+                    os.rename(incomplete_entry, entry)
+                except OSError:
+                    # Another release already stored the revision it was moved to
+                    shutil.rmtree(incomplete_entry)
+            # The modification time of an entry tracks when it was used last
+            os.utime(entry)
+        return entry
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry = f"{self.cache_dir}/{name}"
+            size = sum(os.path.getsize(os.path.join(folder, file)) for folder, _, files in os.walk(entry)
+                       for file in files if not os.path.islink(os.path.join(folder, file)))
+            entries.append((os.path.getmtime(entry), size, entry))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            print(f"Evicting {entry} from the chart cache")
+            shutil.rmtree(entry)
+            total_size -= size
+
+
+def cache_key(*parts) -> str:
+    return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()
+
+
+def resolve_git_revision(repo: GitRepository) -> str:
+    """
+    Resolve the tag or branch of a git repository to the commit it points to. git ls-remote matches refs by their
+    tail, e.g. main matches refs/heads/feature/main as well, so the refs are selected by their exact name.
+    :return: The commit, or the tag itself if the remote has no such tag or branch, e.g. because it is a commit.
+    """
+    # Annotated tags are listed a second time peeled to the commit they point to
+    refs = [f'refs/tags/{repo.tag}^{{}}', f'refs/tags/{repo.tag}', f'refs/heads/{repo.tag}']
+    ls_remote = subprocess.run(['git', 'ls-remote', repo.url] + refs, check=True, capture_output=True, text=True)
+    revisions = {ref: revision for revision, ref in (line.split("\t") for line in ls_remote.stdout.splitlines())}
+    return next((revisions[ref] for ref in refs if ref in revisions), repo.tag)
+
+
+EXACT_CHART_VERSION = re.compile(r'^v?\d+\.\d+\.\d+(-[\w.-]+)?(\+[\w.-]+)?$')
+
+
+def resolve_chart_version(helm_release: HelmRelease) -> str:
+    """
+    Resolve the version constraint of a release to the chart version helm pulls, using the local index of
+    the repository, which has to be added before.
+    """
+    if helm_release.version and EXACT_CHART_VERSION.match(helm_release.version):
+        return helm_release.version
+    chart_name = f"{repository_name(helm_release.repo.url)}/{helm_release.chart}"
+    search = ['helm', 'search', 'repo', chart_name, '--output', 'json']
+    if helm_release.version:
+        search += ['--version', helm_release.version]
+    charts = json.loads(subprocess.run(search, check=True, capture_output=True, text=True).stdout)
+    # The search also matches charts whose name merely contains the chart name
+    versions = [chart["version"] for chart in charts if chart["name"] == chart_name]
+    assert versions, f"Could not find chart {chart_name} in version {helm_release.version}"
+    return versions[0]
+
+
+def clone_git_repository(repo: GitRepository, target_folder) -> str:
+    """
+    :return: The key of the cloned revision, which differs from the resolved one if the ref moved since.
+    """
+    subprocess.run(['git', 'clone', '--depth', '1', '--branch', repo.tag, repo.url, target_folder], check=True)
+    rev_parse = subprocess.run(['git', '-C', target_folder, 'rev-parse', 'HEAD'], check=True, capture_output=True,
+                               text=True)
+    return cache_key("git", repo.url, rev_parse.stdout.strip())
+
+
+def pull_chart(helm_release: HelmRelease, target_folder, version=None):
+    pull = ['helm', 'pull', '--untar', '--untardir', target_folder,
+            f"{repository_name(helm_release.repo.url)}/{helm_release.chart}"]
+    if version := version or helm_release.version:
+        pull += ['--version', version]
+    subprocess.run(pull, check=True)
+
+
+def fetch_chart(helm_release: HelmRelease, target_folder, chart_cache: ChartCache = None):
+    repo = helm_release.repo
+    if type(repo) is HelmRepository:
+        add_repositories([repo.url])
+
+    if not chart_cache:
+        if type(repo) is GitRepository:
+            clone_git_repository(repo, target_folder)
+        else:
+            pull_chart(helm_release, target_folder)
+        return
+
+    if type(repo) is GitRepository:
+        revision = resolve_git_revision(repo)
+        entry = chart_cache.get(cache_key("git", repo.url, revision),
+                                lambda folder: clone_git_repository(repo, folder))
+    else:
+        version = resolve_chart_version(helm_release)
+        entry = chart_cache.get(cache_key("helm", repo.url, helm_release.chart, version),
+                                lambda folder: pull_chart(helm_release, folder, version))
+    # Dependencies are built into the chart folder, so every release works on its own copy
+    shutil.copytree(entry, target_folder, symlinks=True)
+
+
+def template_flags(helm_debug=False) -> List[str]:
+    return ['--debug'] if helm_debug else []
+
+
+def render_helm_release(helm_release: HelmRelease, working_folder, output_folder, chart_cache: ChartCache = None,
+                        helm_debug=False):
+    # Every release gets its own folder, so releases sharing a repository can be rendered in parallel
+    release_folder = f"{working_folder}/{helm_release.output_name}"
+    os.mkdir(release_folder)
+    target_folder = f"{release_folder}/{helm_release.repo.name}"
+    with STEP_TIMINGS.measure(helm_release.output_name, "fetch chart"):
+        fetch_chart(helm_release, target_folder, chart_cache)
+
+    release_value_file_name = f'{release_folder}/{helm_release.name}-values.yaml'
+    with open(release_value_file_name, 'w') as value_file:
+        value_file.write(helm_release.values.values)
+
+    path_to_chart = target_folder + "/" + helm_release.chart
+
+    with STEP_TIMINGS.measure(helm_release.output_name, "build dependencies"):
+        if add_repositories(get_chart_dependency_repo_urls(path_to_chart)):
+            build_chart_dependencies(path_to_chart)
+
+    generated_manifests_file = output_folder + "/" + helm_release.output_name + ".yaml"
+    template = ['helm', '-f', release_value_file_name, 'template', path_to_chart] + template_flags(helm_debug)
+    with STEP_TIMINGS.measure(helm_release.output_name, "template"), open(generated_manifests_file, "w") as helm_output:
+        subprocess.run(template, stdout=helm_output, check=True)
+
+    assert os.path.exists(generated_manifests_file)
+    assert os.path.getsize(generated_manifests_file) > 100
+
+
+def render_all(render, helm_releases, jobs):
+    """
+    Call render for every release on jobs threads. The first failing release aborts the run, releases
+    not started yet are cancelled and its error is raised once the running ones have finished.
+    """
+    failed = threading.Event()
+
+    def render_unless_failed(release):
+        # A worker may pick up the next release before the pending ones are cancelled
+        if failed.is_set():
+            return
+        try:
+            render(release)
+        except BaseException:
+            failed.set()
+            raise
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(render_unless_failed, release) for release in helm_releases]
+        _, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+        for future in not_done:
+            future.cancel()
+    for future in futures:
+        if not future.cancelled() and future.exception():
+            raise future.exception()
+
+
+def get_helm_version() -> str:
+    return subprocess.run(['helm', 'version', '--short'], check=True, capture_output=True, text=True).stdout.strip()
+
+
+def fingerprint_helm_release(helm_release: HelmRelease, helm_version: str, helm_debug=False) -> str:
+    """
+    Fingerprint all inputs of a rendered helm release: the release spec, its values, the resolved revision
+    of the chart source, the helm version and the flags passed to helm template.
+    """
+    repo = helm_release.repo
+    if type(repo) is GitRepository:
+        source = ["git", repo.url, resolve_git_revision(repo)]
+    else:
+        add_repositories([repo.url])
+        source = ["helm", repo.url, resolve_chart_version(helm_release)]
+    return cache_key(helm_version, helm_release.namespace or "", helm_release.name, helm_release.chart,
+                     helm_release.version or "", helm_release.repo_name, helm_release.values.values,
+                     " ".join(template_flags(helm_debug)), *source)
+
+
+def read_fingerprints(fingerprints_file) -> Dict[str, str]:
+    try:
+        with open(fingerprints_file) as json_file:
+            return json.load(json_file)
+    except FileNotFoundError:
+        return {}
+
+
+def write_fingerprints(fingerprints_file, fingerprints: Dict[str, str]):
+    with open(fingerprints_file, "w") as json_file:
+        json.dump(fingerprints, json_file, indent=2, sort_keys=True)
+
+
+def preserve_previous_output(working_folder, output_folder, fingerprints_file):
+    """
+    Move the manifests generated by the last run out of the working directory before it is recreated.
+    :return: The fingerprints of the last run and the folder the manifests were moved to.
+    """
+    previous_output_folder = working_folder.rstrip("/") + ".previous"
+    shutil.rmtree(previous_output_folder, ignore_errors=True)
+    previous_fingerprints = read_fingerprints(fingerprints_file)
+    if os.path.isdir(output_folder):
+        shutil.move(output_folder, previous_output_folder)
+    else:
+        previous_fingerprints = {}
+    return previous_fingerprints, previous_output_folder
+
+
+def render_changed_helm_release(helm_release: HelmRelease, working_folder, output_folder, helm_version,
+                                previous_fingerprints, previous_output_folder, fingerprints,
+                                chart_cache: ChartCache = None, helm_debug=False):
+    with STEP_TIMINGS.measure(helm_release.output_name, "fingerprint"):
+        fingerprint = fingerprint_helm_release(helm_release, helm_version, helm_debug)
+    previous_manifests_file = f"{previous_output_folder}/{helm_release.output_name}.yaml"
+    if previous_fingerprints.get(helm_release.output_name) == fingerprint and os.path.exists(previous_manifests_file):
+        print(f"Inputs of {helm_release.output_name} did not change, reusing its previously generated manifests")
+        shutil.copy2(previous_manifests_file, output_folder)
+    else:
+        render_helm_release(helm_release, working_folder, output_folder, chart_cache, helm_debug)
+    fingerprints[helm_release.output_name] = fingerprint
+
+
 if __name__ == '__main__':
     args = parse_args()
 
     base_path = args.base_path
     working_folder = args.work_dir
     output_folder = working_folder + "/generated"
+    fingerprints_file = working_folder + "/generated.fingerprints.json"
+
+    manifest_cache = ManifestCache(args.manifest_cache) if args.manifest_cache else None
+    all_flux_objects = create_flux_objects_from_files(f"{base_path}/**/*.yaml", args.parse_jobs, manifest_cache)
 
-    all_flux_objects = create_flux_objects_from_files(f"{base_path}/**/*.yaml")
+    if args.incremental:
+        previous_fingerprints, previous_output_folder = preserve_previous_output(working_folder, output_folder,
+                                                                                 fingerprints_file)
 
     recreate_folder(working_folder)
     os.mkdir(output_folder)
 
-    for helm_release in compose_helm_releases(all_flux_objects):
-        target_folder = f"{working_folder}/{helm_release.repo.name}"
-        if type(helm_release.repo) is GitRepository:
-            subprocess.run(['git', 'clone', '--depth', '1', '--branch', helm_release.repo.tag, helm_release.repo.url,
-                        target_folder], check=True)
-        else:
-            add_chart_repositories([(helm_release.repo.name, helm_release.repo.url)])
-            subprocess.run(['helm', 'pull', '--untar', '--untardir', target_folder, f"{helm_release.repo.name}/{helm_release.chart}"], check=True)
-
-        release_value_file_name = f'{working_folder}/{helm_release.name}-values.yaml'
-        with open(release_value_file_name, 'w') as value_file:
-            value_file.write(helm_release.values.values)
+    chart_cache = ChartCache(args.cache_dir, args.cache_max_size * 1024 ** 2) if args.cache_dir else None
 
-        path_to_chart = target_folder + "/" + helm_release.chart
-
-        if add_chart_repositories(get_chart_dependency_repos(path_to_chart)):
-            build_chart_dependencies(path_to_chart)
+    helm_releases = sorted(compose_helm_releases(all_flux_objects), key=lambda release: release.output_name)
+    if args.incremental:
+        helm_version = get_helm_version()
+        fingerprints = {}
+        try:
+            render_all(lambda release: render_changed_helm_release(
+                release, working_folder, output_folder, helm_version, previous_fingerprints,
+                previous_output_folder, fingerprints, chart_cache, args.helm_debug), helm_releases, args.jobs)
+        finally:
+            # Only releases rendered successfully are recorded, all others are rendered again next time
+            write_fingerprints(fingerprints_file, fingerprints)
+            shutil.rmtree(previous_output_folder, ignore_errors=True)
+    else:
+        render_all(lambda release: render_helm_release(release, working_folder, output_folder, chart_cache,
+                                                       args.helm_debug), helm_releases, args.jobs)
 
-        generated_manifests_file = output_folder + "/" + helm_release.name + ".yaml"
-        with open(generated_manifests_file, "w") as helm_output:
-            subprocess.run(['helm', '-f', release_value_file_name, 'template', '--debug', path_to_chart],
-                           stdout=helm_output, check=True)
+    STEP_TIMINGS.print_summary()
 
-        assert os.path.exists(generated_manifests_file)
-        assert os.path.getsize(generated_manifests_file) > 100
+    if chart_cache:
+        chart_cache.evict()
@@ -0,0 +1,62 @@
+import importlib.util
+import os
+import subprocess
+import tempfile
+import unittest
+
+spec = importlib.util.spec_from_file_location("helm_helpers", os.path.dirname(__file__) + "/helm-helpers.py")
+helm_helpers = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(helm_helpers)
+
+
+class TestResolveGitRevision(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.url = self.temp_dir.name
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def git(self, *args):
+        return subprocess.run(['git', '-C', self.url, '-c', 'user.name=test', '-c', 'user.email=test@example.com']
+                              + list(args), check=True, capture_output=True, text=True).stdout.strip()
+
+    def commit(self, message):
+        self.git('commit', '--allow-empty', '-q', '-m', message)
+        return self.git('rev-parse', 'HEAD')
+
+    def resolve(self, tag):
+        return helm_helpers.resolve_git_revision(helm_helpers.GitRepository(name="repo", url=self.url, tag=tag))
+
+    def test_branch_is_not_confused_with_branch_of_same_tail(self):
+        self.git('init', '-q', '-b', 'main')
+        main = self.commit('main')
+        self.git('checkout', '-q', '-b', 'feature/main')
+        self.commit('feature')
+        assert self.resolve('main') == main
+
+    def test_annotated_tag_is_peeled(self):
+        self.git('init', '-q', '-b', 'main')
+        tagged = self.commit('tagged')
+        self.git('tag', '-a', 'v1.0.0', '-m', 'release')
+        self.git('branch', 'release/v1.0.0')
+        self.commit('later')
+        assert self.resolve('v1.0.0') == tagged
+
+    def test_tag_is_preferred_over_branch(self):
+        self.git('init', '-q', '-b', 'main')
+        tagged = self.commit('tagged')
+        self.git('tag', 'v1.0.0')
+        self.git('checkout', '-q', '-b', 'v1.0.0')
+        self.commit('branch')
+        assert self.resolve('v1.0.0') == tagged
+
+    def test_unknown_ref_is_returned_unchanged(self):
+        self.git('init', '-q', '-b', 'main')
+        commit = self.commit('main')
+        assert self.resolve(commit) == commit
+
+
+if __name__ == '__main__':
+    unittest.main()
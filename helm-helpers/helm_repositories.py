@@ -0,0 +1,38 @@
+"""
+Adds the helm repositories charts are pulled from, shared by the helm helper scripts.
+Repositories are added under a name derived from their url. Flux HelmRepositories in different namespaces and the
+dependencies of different charts may share their name, but a derived name never points to another url.
+"""
+import re
+import subprocess
+import threading
+
+# helm repo add rewrites the shared repositories file, so charts handled in parallel take turns
+HELM_REPO_LOCK = threading.Lock()
+# Urls of the repositories added during this run, their indexes are up-to-date and need not be downloaded again
+ADDED_REPOSITORIES = set()
+
+
+def repository_name(repository_url: str) -> str:
+    # helm dependency build finds repositories by their url, their name does not matter
+    return re.sub(r'[^\w.-]+', '-', repository_url).strip('-')
+
+
+def add_repositories(repository_urls) -> bool:
+    """
+    Add the repositories, unless they have been added during this run already.
+    :param repository_urls: The urls of the repositories.
+    :return: Whether at least one repository url was given.
+    """
+    at_least_one_repo = False
+    for repository_url in repository_urls:
+        with HELM_REPO_LOCK:
+            if repository_url not in ADDED_REPOSITORIES:
+                # Forcing the update downloads the index even if the repository is configured already,
+                # so each index is refreshed exactly once per run
+                subprocess.run(['helm', 'repo', 'add', '--force-update', repository_name(repository_url),
+                                repository_url], check=True)
+                ADDED_REPOSITORIES.add(repository_url)
+                print(f'\033[92m\U00002714 Successfully added helm repository {repository_url}\033[0m')
+        at_least_one_repo = True
+    return at_least_one_repo
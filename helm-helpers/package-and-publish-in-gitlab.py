@@ -1,17 +1,23 @@
+import glob
+import hashlib
+import json
 import os
 import re
 import requests
+import shutil
 import subprocess
 import sys
+import threading
 import yaml
 
+from concurrent.futures import ThreadPoolExecutor
 from requests.auth import HTTPBasicAuth
 
+from helm_repositories import add_repositories
 
-def add_dependency_repositories(chart_yaml: str):
-    for dependency in chart_yaml["dependencies"]:
-        subprocess.run(['helm', 'repo', 'add', dependency["name"], dependency["repository"]], check=True)
-        print(f'\033[92m\U00002714 Successfully added helm repository {dependency["name"]}\033[0m')
+
+def add_dependency_repositories(chart_lock):
+    add_repositories(dependency["repository"] for dependency in chart_lock["dependencies"])
 
 
 def update_dependencies():
@@ -19,39 +25,105 @@ def update_dependencies():
     print(f'\033[92m\U00002714 Successfully updated dependencies \033[0m')
 
 
-def build_dependencies():
-    subprocess.run(['helm', 'dependency', 'build'], check=True)
-    print(f'\033[92m\U00002714 Successfully built dependencies \033[0m')
+def build_dependencies(chart_path: str):
+    # The indexes of all dependency repositories were just refreshed when they were added
+    subprocess.run(['helm', 'dependency', 'build', '--skip-refresh'], check=True, cwd=chart_path)
+    print(f'\033[92m\U00002714 Successfully built dependencies of {chart_path} \033[0m')
+
+
+def dependency_cache_key(chart_lock, chart_yaml) -> str | None:
+    """
+    Key of the subcharts of a chart, derived from the digest of its Chart.lock, the exact version
+    of every dependency and the dependencies declared in Chart.yaml. A Chart.yaml changed without
+    updating the lock therefore misses the cache and fails in helm dependency build as before.
+    Charts with local dependencies are not cached, as those change without a new version.
+    """
+    dependencies = chart_lock["dependencies"]
+    if any(dependency["repository"].startswith("file://") for dependency in dependencies):
+        return None
+    parts = [chart_lock["digest"]] + [f'{dependency["name"]}|{dependency["repository"]}|{dependency["version"]}'
+                                      for dependency in dependencies]
+    parts.append(json.dumps(chart_yaml.get("dependencies"), sort_keys=True))
+    return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
+
+
+def restore_dependencies(chart_path: str, cache_entry: str) -> bool:
+    if not os.path.isdir(cache_entry):
+        return False
+    os.makedirs(f'{chart_path}/charts', exist_ok=True)
+    # Subcharts of other versions would be packaged as well
+    for stale_subchart in glob.glob(f'{chart_path}/charts/*.tgz'):
+        os.remove(stale_subchart)
+    for subchart in glob.glob(f'{cache_entry}/*.tgz'):
+        shutil.copy2(subchart, f'{chart_path}/charts')
+    print(f'\033[92m\U00002714 Successfully restored dependencies of {chart_path} from {cache_entry} \033[0m')
+    return True
+
+
+def store_dependencies(chart_path: str, cache_entry: str):
+    incomplete_entry = f'{cache_entry}.{os.getpid()}.{threading.get_ident()}.incomplete'
+    os.makedirs(incomplete_entry)
+    for subchart in glob.glob(f'{chart_path}/charts/*.tgz'):
+        shutil.copy2(subchart, incomplete_entry)
+    try:
+        os.rename(incomplete_entry, cache_entry)
+    except OSError:
+        # Another chart with the same dependencies stored them first
+        shutil.rmtree(incomplete_entry)
+
+
+def provide_dependencies(chart_path: str, cache_dir: str = None):
+    with open(f'{chart_path}/Chart.lock', 'r') as chart_file:
+        chart_lock = yaml.safe_load(chart_file)
+    with open(f'{chart_path}/Chart.yaml', 'r') as chart_file:
+        chart_yaml = yaml.safe_load(chart_file)
+
+    cache_key = dependency_cache_key(chart_lock, chart_yaml) if cache_dir else None
+    if cache_key and restore_dependencies(chart_path, f'{cache_dir}/{cache_key}'):
+        return
 
+    add_dependency_repositories(chart_lock)
+    build_dependencies(chart_path)
+    if cache_key:
+        store_dependencies(chart_path, f'{cache_dir}/{cache_key}')
 
-def package_chart() -> str:
-    package_output = subprocess.run(['helm', 'package', '.'], check=True, capture_output=True)
+
+def package_chart(chart_path: str) -> str:
+    package_output = subprocess.run(['helm', 'package', '.'], check=True, capture_output=True, cwd=chart_path)
 
     chart_file_name = re.search('[^/]+$', package_output.stdout.decode("utf-8").strip()).group(0)
 
     print(f'\033[92m\U00002714 Successfully packaged chart and saved it to {chart_file_name} \033[0m')
-    return chart_file_name
+    return f'{chart_path}/{chart_file_name}'
 
 
 def upload_chart(helm_package_file_name):
     url = f'{os.getenv("CI_API_V4_URL")}/projects/{os.getenv("CI_PROJECT_ID")}/packages/helm/api/stable/charts'
-    files = {'chart': open(helm_package_file_name, 'rb')}
-    response = requests.post(url, files=files, auth=HTTPBasicAuth('gitlab-ci-token', os.getenv("CI_JOB_TOKEN")))
+    with open(helm_package_file_name, 'rb') as helm_package:
+        response = requests.post(url, files={'chart': helm_package},
+                                 auth=HTTPBasicAuth('gitlab-ci-token', os.getenv("CI_JOB_TOKEN")))
     if not response.ok:
-        raise Exception(f"Could not upload chart: {response.status_code}")
+        raise Exception(f"Could not upload chart {helm_package_file_name}: {response.status_code}")
     else:
-        print(f'\033[92m\U00002714 Successfully uploaded chart \033[0m')
+        print(f'\033[92m\U00002714 Successfully uploaded chart {helm_package_file_name} \033[0m')
 
 
-if __name__ == '__main__':
+def package_and_publish(chart_path: str, cache_dir: str = None):
+    provide_dependencies(chart_path, cache_dir)
+    helm_package_file_name = package_chart(chart_path)
+    upload_chart(helm_package_file_name)
 
-    chart_path = f'{os.getenv("CI_PROJECT_DIR")}/{sys.argv[1]}'
-    os.chdir(chart_path)
 
-    with open(f'Chart.lock', 'r') as chart_file:
-        chart_yaml = yaml.safe_load(chart_file)
+if __name__ == '__main__':
 
-    add_dependency_repositories(chart_yaml)
-    build_dependencies()
-    helm_package_file_name = package_chart()
-    upload_chart(helm_package_file_name)
+    # Several charts can be given, they are packaged and uploaded in parallel
+    chart_paths = [f'{os.getenv("CI_PROJECT_DIR")}/{chart}' for chart in sys.argv[1:]]
+    # Subcharts are cached in this folder, e.g. one kept by the GitLab CI cache, if it is set
+    dependency_cache_dir = os.getenv("HELM_DEPENDENCY_CACHE")
+    if dependency_cache_dir:
+        os.makedirs(dependency_cache_dir, exist_ok=True)
+
+    with ThreadPoolExecutor(max_workers=int(os.getenv("PUBLISH_CONCURRENCY", "4"))) as executor:
+        # Consume the results to raise the first error of a failed chart
+        for _ in executor.map(lambda chart_path: package_and_publish(chart_path, dependency_cache_dir), chart_paths):
+            pass